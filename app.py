@@ -1,13 +1,30 @@
+import atexit
+import hashlib
+import hmac
+import io
+import json
 import os
 import re
+import threading
+import time
 import unicodedata
+from contextlib import contextmanager
+from dataclasses import dataclass
 from functools import wraps
 
+import jinja2
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
 import psycopg2.extras
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+import psycopg2.pool
+from flask import Flask, g, make_response, render_template, request, redirect, url_for, flash, session
+from flask_compress import Compress
+from werkzeug.routing import BaseConverter
 
 app = Flask(__name__)
+# templates compilados a disco: un worker nuevo no vuelve a parsear cada .html
+app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache()
 
 WAREHOUSE_LABELS = {
     "WH1": "Warehouse Mittera",
@@ -30,23 +47,131 @@ APP_PASS = os.environ.get("APP_PASS", "mittera")
 GUEST_USER = os.environ.get("GUEST_USER", "guest")
 GUEST_PASS = os.environ.get("GUEST_PASS", "mitterapompano")
 
+# Vida del login en segundos; la cookie solo viaja por HTTPS salvo AUTH_COOKIE_SECURE=0 (local)
+AUTH_MAX_AGE = int(os.environ.get("AUTH_MAX_AGE", str(12 * 3600)))
+AUTH_COOKIE_SECURE = os.environ.get("AUTH_COOKIE_SECURE", "1") == "1"
+
+# Size PG_POOL_MAX to the number of gunicorn workers x threads sharing the DB.
+PG_POOL_MIN = int(os.environ.get("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.environ.get("PG_POOL_MAX", "10"))
+PG_POOL_TIMEOUT = float(os.environ.get("PG_POOL_TIMEOUT", "30"))
+# PREPARE vive en la sesion del servidor; apagarlo si hay un pooler en modo transaction delante
+PG_PREPARE = os.environ.get("PG_PREPARE", "1") != "0"
+# Con 1, los batch (add/remove/transfer) confirman sin esperar el fsync del WAL: ante un
+# crash del servidor se pueden perder los ultimos ~600ms de batches ya confirmados al usuario
+PG_ASYNC_BATCH_COMMIT = os.environ.get("PG_ASYNC_BATCH_COMMIT", "0") == "1"
+# En Render va "require"; staging/local pueden usar "prefer" o "disable" y ahorrarse el TLS
+PG_SSLMODE = os.environ.get("PG_SSLMODE", "require")
+# keepalives de TCP: una conexion del pool que murio en silencio se detecta en segundos,
+# no cuando una request la usa y se queda colgada
+PG_CONNECT_OPTS = {
+    "keepalives": 1,
+    "keepalives_idle": 30,
+    "keepalives_interval": 10,
+    "keepalives_count": 3,
+    "tcp_user_timeout": 5000,
+}
+
+# Subir SCHEMA_VERSION cada vez que init_db cambie el DDL; si no, los deploys no migran
+SCHEMA_VERSION = 8
+SCHEMA_LOCK_ID = 7_421_001
+SCHEMA_LOCK_POLL = 0.5  # segundos entre intentos de tomar el lock de la migracion
+
+
+def _code_fingerprint() -> str:
+    """Hash de app.py y los templates: igual en todos los workers del mismo deploy."""
+    h = hashlib.blake2b(digest_size=6)
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    paths = [os.path.abspath(__file__)] + sorted(
+        os.path.join(root, name) for root, _, names in os.walk(template_dir) for name in names
+    )
+    for path in paths:
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+# Parte del ETag de /inventory: un deploy nuevo (templates nuevos) invalida lo cacheado
+ETAG_SALT = os.environ.get("RENDER_GIT_COMMIT", "")[:12] or _code_fingerprint()
+
 WH_LOCATIONS = {
-    "WH1": [str(i).zfill(2) for i in range(1, 21)],
-    "WH2": [str(i).zfill(2) for i in range(21, 51)],
-    "USED": ["USED"],
+    "WH1": tuple(str(i).zfill(2) for i in range(1, 21)),
+    "WH2": tuple(str(i).zfill(2) for i in range(21, 51)),
+    "USED": ("USED",),
 }
+# mismas ubicaciones como frozenset, para validar formularios sin recorrer la lista
+WH_LOCATION_SETS = {wh: frozenset(locs) for wh, locs in WH_LOCATIONS.items()}
 ALLOWED_WAREHOUSES = ("WH1", "WH2", "USED")
 
+MOVEMENT_FIELDS = ("roll_id", "action", "from_wh", "to_wh", "from_loc", "to_loc")
+
+# Valores de movements.action (indexado junto con la fecha, ver movements_action_ts)
+ACT_ADD = "ADD"
+ACT_BATCH_ADD = "BATCH_ADD"
+ACT_EDIT_MOVE = "EDIT_MOVE"
+ACT_DELETE = "DELETE"
+ACT_TO_USED_PC = "TO_USED_PC"
+ACT_REMOVE_TO_USED = "REMOVE_TO_USED"
+ACT_BATCH_REMOVE_TO_USED = "BATCH_REMOVE_TO_USED"
+ACT_TRANSFER = "TRANSFER"
+ACT_MOVE_WITHIN_WH = "MOVE_WITHIN_WH"
+ACT_BATCH_TRANSFER = "BATCH_TRANSFER"
+ACT_BATCH_MOVE_WITHIN_WH = "BATCH_MOVE_WITHIN_WH"
+
+# filas por sentencia en los INSERT multi-VALUES de los batch
+BATCH_PAGE_SIZE = 500
+
 
 def locations_for(warehouse: str):
-    return WH_LOCATIONS.get((warehouse or "").upper().strip(), [])
+    # casi siempre llega ya normalizado (templates, converter de rutas): sin upper/strip
+    locs = WH_LOCATIONS.get(warehouse)
+    if locs is not None:
+        return locs
+    return WH_LOCATIONS.get((warehouse or "").upper().strip(), ())
+
+
+def is_valid_loc(warehouse: str, location: str) -> bool:
+    return location in WH_LOCATION_SETS.get(warehouse, frozenset())
 
 
 app.jinja_env.globals["locations_for"] = locations_for
 
+# gzip/brotli para HTML y JSON; las tablas de inventario comprimen ~5x
+Compress(app)
+
+
+def matching_etag(etag: str):
+    """
+    Devuelve el ETag (entre comillas) de If-None-Match que corresponde a etag, o None.
+    Flask-Compress agrega ":gzip"/":br" al ETag de las respuestas comprimidas, asi que el
+    navegador puede mandar cualquiera de esas variantes.
+    """
+    inm = request.if_none_match
+    for tag in [etag] + [f"{etag}:{alg}" for alg in app.config["COMPRESS_ALGORITHM"]]:
+        if inm.contains(tag):
+            return f'"{tag}"'
+    return None
+
+
+class WarehouseConverter(BaseConverter):
+    """
+    <wh:warehouse> acepta WH1/WH2/USED (o los indicados, <wh("WH1","WH2"):...>) sin importar
+    mayusculas y los entrega en mayusculas; cualquier otro valor es 404 desde el routing.
+    """
+
+    def __init__(self, url_map, *allowed):
+        super().__init__(url_map)
+        self.regex = "(?i:" + "|".join(allowed or ALLOWED_WAREHOUSES) + ")"
+
+    def to_python(self, value):
+        return value.upper()
+
+
+app.url_map.converters["wh"] = WarehouseConverter
+
 
 def clean(s: str) -> str:
-    return (s or "").strip()
+    return s.strip() if s else ""
 
 def clean_envelope_name(s: str) -> str:
     s = (s or "").strip().upper()
@@ -75,7 +200,11 @@ def envelope_type_prefix(envelope_type: str) -> str:
     return compact[:10]
 
 
-def next_envelope_pallet_id(cur, envelope_type: str) -> str:
+def next_envelope_pallet_ids(cur, envelope_type: str, count: int):
+    """
+    Los proximos `count` IDs de pallet del tipo, con una sola consulta.
+    El caller debe tener lockeada la fila del tipo en envelope_inventory.
+    """
     prefix = envelope_type_prefix(envelope_type)
 
     cur.execute(
@@ -96,8 +225,95 @@ def next_envelope_pallet_id(cur, envelope_type: str) -> str:
         if m:
             last_num = int(m.group(1))
 
-    new_num = last_num + 1
-    return f"{prefix}-{str(new_num).zfill(4)}"
+    return [f"{prefix}-{str(last_num + i).zfill(4)}" for i in range(1, count + 1)]
+
+
+def insert_envelope_pallets(cur, pallet_ids, envelope_type: str, prefix: str):
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO envelope_pallets (pallet_id, envelope_type, type_prefix, status) VALUES %s",
+        [(pallet_id, envelope_type, prefix) for pallet_id in pallet_ids],
+        template="(%s, %s, %s, 'IN_STOCK')",
+        page_size=BATCH_PAGE_SIZE,
+    )
+
+
+def set_envelope_pallets_status(cur, pallet_ids, to_used: bool):
+    """
+    Pasa varios pallets a USED (to_used) o de vuelta a IN_STOCK en un solo statement,
+    y ajusta pallet_count de cada tipo por la cantidad que realmente cambio.
+    Devuelve {pallet_id: cambio} con los IDs que existen; los que no existen no aparecen.
+    """
+    if to_used:
+        set_status, only_from, count = "USED", "status IS DISTINCT FROM 'USED'", "GREATEST(0, i.pallet_count - c.n)"
+    else:
+        set_status, only_from, count = "IN_STOCK", "status = 'USED'", "i.pallet_count + c.n"
+
+    # El SELECT final ve el snapshot de antes del UPDATE: trae todos los IDs que existian
+    cur.execute(
+        f"""
+        WITH upd AS (
+            UPDATE envelope_pallets
+            SET status = '{set_status}'
+            WHERE pallet_id = ANY(%s) AND {only_from}
+            RETURNING pallet_id, envelope_type
+        ),
+        counts AS (
+            UPDATE envelope_inventory i
+            SET pallet_count = {count},
+                updated_at = NOW()
+            FROM (SELECT envelope_type, COUNT(*) AS n FROM upd GROUP BY envelope_type) c
+            WHERE i.envelope_type = c.envelope_type
+        )
+        SELECT p.pallet_id, u.pallet_id IS NOT NULL
+        FROM envelope_pallets p
+        LEFT JOIN upd u ON u.pallet_id = p.pallet_id
+        WHERE p.pallet_id = ANY(%s)
+        """,
+        (list(pallet_ids), list(pallet_ids)),
+    )
+    return dict(cur.fetchall())
+
+
+def safe_rename_envelope_type(cur, old_name: str, new_name: str, new_prefix: str = None):
+    """
+    Renombra un tipo en un solo statement. Devuelve (existia, renombrado); existia sin
+    renombrado quiere decir que new_name ya esta tomado.
+    Con new_prefix tambien se renombran sus pallets.
+    """
+    pallets = ""
+    params = [old_name, new_name, new_name]
+    if new_prefix is not None:
+        pallets = """,
+        pallets AS (
+            UPDATE envelope_pallets
+            SET envelope_type = %s,
+                type_prefix = %s
+            WHERE envelope_type = %s AND EXISTS (SELECT 1 FROM upd)
+        )"""
+        params += [new_name, new_prefix, old_name]
+
+    cur.execute(
+        f"""
+        WITH old AS (
+            SELECT id FROM envelope_inventory WHERE envelope_type = %s
+        ),
+        taken AS (
+            SELECT 1 FROM envelope_inventory WHERE envelope_type = %s
+        ),
+        upd AS (
+            UPDATE envelope_inventory i
+            SET envelope_type = %s,
+                updated_at = NOW()
+            FROM old
+            WHERE i.id = old.id AND NOT EXISTS (SELECT 1 FROM taken)
+            RETURNING i.id
+        ){pallets}
+        SELECT EXISTS (SELECT 1 FROM old), EXISTS (SELECT 1 FROM upd)
+        """,
+        tuple(params),
+    )
+    return cur.fetchone()
 
 
 def parse_weight(s: str):
@@ -105,22 +321,39 @@ def parse_weight(s: str):
     if not s:
         return None
     try:
-        w = int(float(s))
-        return w if w > 0 else None
-    except Exception:
+        # camino rapido: la mayoria de los pesos escaneados son enteros sin decimales
+        w = int(s) if s.isdigit() else int(float(s))
+    except (ValueError, OverflowError):
         return None
+    return w if w > 0 else None
 
 
 def looks_like_scanned_weight(roll_id: str) -> bool:
     # block ONLY 4-digit numeric values; 5-digit IDs are allowed
     return bool(re.fullmatch(r"\d{4}", clean(roll_id)))
 
+# comas y punto y coma pasan a espacio; str.split() sin argumentos corta por cualquier espacio
+_ID_SEPARATORS = str.maketrans(",;", "  ")
+
+
 def parse_roll_ids_multiline(raw_text: str):
     if not raw_text:
         return []
 
-    ids = [x.strip() for x in re.split(r"[\s,;]+", raw_text) if x.strip()]
-    return list(dict.fromkeys(ids))
+    # translate + split corren en C y no dejan vacios, sin pasar por el motor de regex
+    return list(dict.fromkeys(raw_text.translate(_ID_SEPARATORS).split()))
+
+def paper_tsvector_sql(paper_col: str) -> str:
+    """
+    tsvector del paper type. Guiones, puntos y barras pasan a espacio para que "GLOSS-80"
+    indexe 'gloss' y '80'. Tiene que coincidir letra por letra con el indice rolls_paper_fts.
+    """
+    return f"to_tsvector('simple', translate({paper_col}, '-_/.,+', '      '))"
+
+
+# palabras de una busqueda, partidas igual que paper_tsvector_sql parte el paper type
+_SEARCH_TERMS = re.compile(r"[^\W_]+")
+
 
 def parse_bulk_roll_rows(raw_text: str):
     """
@@ -257,22 +490,144 @@ def parse_bulk_rolls_input(raw_text: str):
     return paper_type, unique_rows, errors
 
 
-def get_conn():
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL missing in Render env vars.")
-    return psycopg2.connect(DATABASE_URL, sslmode="require")
+class PreparingConnection(psycopg2.extensions.connection):
+    """
+    Conexion que recuerda que statements ya preparo.
+    PREPARE es por sesion, asi que cada conexion del pool lleva su propio registro.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+
+
+_PLACEHOLDER_RE = re.compile(r"%%|%s")
+
+
+def execute_prepared(cur, sql: str, params=()):
+    """
+    Ejecuta sql (con placeholders %s) como prepared statement del servidor.
+    La primera vez en cada conexion hace PREPARE; despues solo EXECUTE, sin parse/plan.
+    """
+    prepared = getattr(cur.connection, "prepared", None)
+    if prepared is None:
+        cur.execute(sql, params)
+        return
+
+    name = prepared.get(sql)
+    if name is None:
+        counter = iter(range(1, len(params) + 1))
+        pg_sql = _PLACEHOLDER_RE.sub(lambda m: "%" if m.group() == "%%" else f"${next(counter)}", sql)
+        name = f"stmt_{len(prepared) + 1}"
+        cur.execute(f"PREPARE {name} AS {pg_sql}")
+        prepared[sql] = name
+
+    if params:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(PG_POOL_MAX)
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                if not DATABASE_URL:
+                    raise RuntimeError("DATABASE_URL missing in Render env vars.")
+                # el pool abre PG_POOL_MIN conexiones (y sus handshakes TLS) al crearse,
+                # asi que init_db al importar deja el worker precalentado
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    PG_POOL_MIN, PG_POOL_MAX, DATABASE_URL, sslmode=PG_SSLMODE,
+                    connection_factory=PreparingConnection if PG_PREPARE else None,
+                    **PG_CONNECT_OPTS,
+                )
+    return _pool
+
+
+def close_pool():
+    """Cierra las conexiones del pool al salir el worker, asi Postgres no las ve colgadas."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+        _pool = None
+
+
+atexit.register(close_pool)
+
+
+@contextmanager
+def get_conn(readonly: bool = False):
+    """
+    Borrow a connection from the process-wide pool.
+    ThreadedConnectionPool raises instead of waiting when it runs dry, so a
+    semaphore makes callers queue for a free slot. Any transaction left open
+    is rolled back by the pool when the connection is returned.
+
+    readonly=True lends the connection in autocommit mode, so read views skip
+    the implicit BEGIN and the rollback on return. Only use it for SELECTs.
+    """
+    if not _pool_slots.acquire(timeout=PG_POOL_TIMEOUT):
+        raise RuntimeError("Timed out waiting for a database connection.")
+    try:
+        pool = get_pool()
+        conn = pool.getconn()
+        if conn.closed:
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        if readonly:
+            conn.autocommit = True
+        try:
+            yield conn
+        finally:
+            if readonly and not conn.closed:
+                conn.autocommit = False
+            pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        _pool_slots.release()
+
+
+# table -> frozenset de columnas. El esquema solo cambia dentro de init_db,
+# asi que los requests nunca vuelven a consultar el catalogo.
+_TABLE_COLS = {}
+
+# (funcion, args) -> SQL armado a partir de esas columnas; se invalida junto con _TABLE_COLS
+_SCHEMA_SQL = {}
+
+
+def forget_table_cols(table: str = None):
+    if table is None:
+        _TABLE_COLS.clear()
+    else:
+        _TABLE_COLS.pop(table, None)
+    _SCHEMA_SQL.clear()
+
+
+def schema_sql(fn):
+    """
+    Memoiza un armador de SQL fn(cur, *args) cuyo resultado depende solo del esquema y de args,
+    asi los requests no vuelven a armar las mismas expresiones y f-strings en cada llamada.
+    """
+    @wraps(fn)
+    def wrapper(cur, *args):
+        key = (fn, args)
+        out = _SCHEMA_SQL.get(key)
+        if out is None:
+            out = fn(cur, *args)
+            if out is not None:
+                _SCHEMA_SQL[key] = out
+        return out
+    return wrapper
 
 
 def col_exists(cur, table, col):
-    cur.execute(
-        """
-        SELECT 1
-        FROM information_schema.columns
-        WHERE table_name=%s AND column_name=%s
-        """,
-        (table, col),
-    )
-    return cur.fetchone() is not None
+    return col in get_table_cols(cur, table)
 
 
 def _colname_from_row(row):
@@ -285,12 +640,18 @@ def _colname_from_row(row):
     return None
 
 
-def get_table_cols(cur, table: str) -> set[str]:
+def get_table_cols(cur, table: str) -> frozenset[str]:
+    cached = _TABLE_COLS.get(table)
+    if cached is not None:
+        return cached
+
+    # pg_attribute directo: information_schema.columns es una vista con joins y chequeos de
+    # permisos por fila. to_regclass devuelve NULL (sin filas) si la tabla todavia no existe.
     cur.execute(
         """
-        SELECT column_name
-        FROM information_schema.columns
-        WHERE table_name=%s
+        SELECT attname AS column_name
+        FROM pg_attribute
+        WHERE attrelid=to_regclass(%s) AND attnum > 0 AND NOT attisdropped
         """,
         (table,),
     )
@@ -300,7 +661,11 @@ def get_table_cols(cur, table: str) -> set[str]:
         name = _colname_from_row(row)
         if name:
             out.add(name)
-    return out
+
+    # no cachear tablas que todavia no existen
+    if out:
+        _TABLE_COLS[table] = frozenset(out)
+    return frozenset(out)
 
 
 def rolls_columns(cols: set[str]):
@@ -331,136 +696,404 @@ def read_form_location():
     return clean(request.form.get("location") or request.form.get("sublocation") or "")
 
 
-def log_movement(cur, **fields):
+def relax_batch_commit(cur):
+    """synchronous_commit=off solo para esta transaccion, si PG_ASYNC_BATCH_COMMIT esta activo."""
+    if PG_ASYNC_BATCH_COMMIT:
+        cur.execute("SET LOCAL synchronous_commit = off")
+
+
+def copy_value(v) -> str:
+    """Formatea un valor para COPY ... FROM STDIN en formato text (\\N es NULL)."""
+    if v is None:
+        return "\\N"
+    return (
+        str(v)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def log_movements(cur, rows):
+    """
+    Registra muchos movimientos con un solo COPY ... FROM STDIN.
+    Cada row es un dict con las llaves de MOVEMENT_FIELDS.
+    ts_utc/moved_at salen del DEFAULT NOW() que pone init_db.
+    """
+    if not rows:
+        return
+
+    cols = get_table_cols(cur, "movements")
+    keys = [k for k in MOVEMENT_FIELDS if k in cols]
+    if not keys:
+        return
+
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(copy_value(row.get(k)) for k in keys))
+        buf.write("\n")
+    buf.seek(0)
+
+    cur.copy_expert(f"COPY movements ({', '.join(keys)}) FROM STDIN", buf)
+
+
+@dataclass(frozen=True)
+class RollsSchema:
+    """Columnas de rolls ya resueltas, con las expresiones COALESCE de los esquemas legacy."""
+    paper_col: str
+    wh_col: str
+    weight_cols: tuple
+    loc_cols: tuple
+    weight_expr: str
+    loc_expr: str
+
+
+@schema_sql
+def rolls_schema(cur) -> RollsSchema:
+    """RollsSchema del esquema actual; se arma una vez y se invalida con forget_table_cols."""
+    cols = get_table_cols(cur, "rolls")
+    paper_col, wh_col, weight_cols, loc_cols, _ = rolls_columns(cols)
+
+    if not paper_col or not wh_col or not weight_cols or not loc_cols:
+        raise RuntimeError(f"rolls schema unsupported. cols={sorted(list(cols))}")
+
+    return RollsSchema(
+        paper_col=paper_col,
+        wh_col=wh_col,
+        weight_cols=tuple(weight_cols),
+        loc_cols=tuple(loc_cols),
+        weight_expr="COALESCE(weight_lbs, weight)" if len(weight_cols) > 1 else weight_cols[0],
+        loc_expr="COALESCE(location, sublocation)" if len(loc_cols) > 1 else loc_cols[0],
+    )
+
+
+@schema_sql
+def _roll_fields_sql(cur) -> str:
+    rs = rolls_schema(cur)
+
+    return f"""roll_id,
+               {rs.paper_col} AS paper_type,
+               {rs.weight_expr} AS weight,
+               {rs.wh_col} AS warehouse,
+               {rs.loc_expr} AS location"""
+
+
+@schema_sql
+def _select_rolls_sql(cur, where: str, fields: str = None) -> str:
+    return f"""
+        SELECT {fields or _roll_fields_sql(cur)}
+        FROM rolls
+        WHERE {where}
+        """
+
+
+_IDS_VALUES_WHERE = "roll_id IN (SELECT v.roll_id FROM (VALUES %s) AS v(roll_id))"
+
+
+def safe_select_roll_places(cur, roll_ids, lock: bool = False):
+    """
+    Busca donde estan varios rolls en un solo round-trip.
+    Devuelve {roll_id: (warehouse, location)}; los IDs que no existen simplemente no aparecen.
+    Pensado para los batch: cur debe ser un cursor de tuplas, sin un dict por fila.
+    """
+    if not roll_ids:
+        return {}
+
+    roll_ids = list(roll_ids)
+    # NO KEY: los batch solo mueven warehouse/location, nunca cambian roll_id.
+    # Los locks se toman en orden de roll_id y no en el del pegado: dos batch que se
+    # solapan con los IDs en distinto orden se esperan en vez de hacer deadlock.
+    lock_sql = " ORDER BY roll_id FOR NO KEY UPDATE" if lock else ""
+    rs = rolls_schema(cur)
+    fields = f"roll_id, {rs.wh_col}, {rs.loc_expr}"
+
+    # Con listas grandes ANY(array) tiende a seq scan; un VALUES deja al planner hacer hash join
+    if len(roll_ids) > BATCH_PAGE_SIZE:
+        rows = psycopg2.extras.execute_values(
+            cur,
+            _select_rolls_sql(cur, _IDS_VALUES_WHERE, fields) + lock_sql,
+            [(rid,) for rid in roll_ids],
+            page_size=len(roll_ids),
+            fetch=True,
+        )
+    else:
+        cur.execute(_select_rolls_sql(cur, "roll_id = ANY(%s)", fields) + lock_sql, (roll_ids,))
+        rows = cur.fetchall()
+
+    return {rid: (wh, loc) for rid, wh, loc in rows}
+
+
+@schema_sql
+def _movement_insert_sql(cur, source: str):
+    """
+    INSERT INTO movements ... SELECT ... FROM source, para encadenarlo en un CTE.
+    source tiene que exponer roll_id, action, from_wh, to_wh, from_loc, to_loc.
+    Devuelve None si la tabla movements no tiene ninguna de esas columnas.
+    """
     cols = get_table_cols(cur, "movements")
 
-    if "to_wh" in cols and not fields.get("to_wh"):
-        fields["to_wh"] = fields.get("from_wh") or "USED"
-    if "to_loc" in cols and not fields.get("to_loc"):
-        fields["to_loc"] = fields.get("from_loc") or "USED"
+    keys = [k for k in MOVEMENT_FIELDS if k in cols]
+    if not keys:
+        return None
 
     insert_cols = []
-    insert_vals = []
-    params = []
+    select_vals = []
 
     if "ts_utc" in cols:
         insert_cols.append("ts_utc")
-        insert_vals.append("NOW()")
+        select_vals.append("NOW()")
     if "moved_at" in cols:
         insert_cols.append("moved_at")
-        insert_vals.append("NOW()")
+        select_vals.append("NOW()")
 
-    for k in ("roll_id", "action", "from_wh", "to_wh", "from_loc", "to_loc"):
-        if k in cols and k in fields:
-            insert_cols.append(k)
-            insert_vals.append("%s")
-            params.append(fields[k])
+    insert_cols.extend(keys)
+    select_vals.extend(f"{source}.{k}" for k in keys)
 
-    if not insert_cols:
-        return
+    return f"INSERT INTO movements ({', '.join(insert_cols)}) SELECT {', '.join(select_vals)} FROM {source}"
 
-    q = f"INSERT INTO movements ({', '.join(insert_cols)}) VALUES ({', '.join(insert_vals)})"
-    cur.execute(q, tuple(params))
 
+def _with_movement(cur, source: str, action: str) -> str:
+    if not action:
+        return ""
+    mv_sql = _movement_insert_sql(cur, source)
+    return f", mv AS ({mv_sql})" if mv_sql else ""
 
-def safe_select_roll(cur, roll_id: str):
-    cols = get_table_cols(cur, "rolls")
-    paper_col, wh_col, weight_cols, loc_cols, _ = rolls_columns(cols)
 
-    if not paper_col or not wh_col or not weight_cols or not loc_cols:
-        raise RuntimeError(f"rolls schema unsupported. cols={sorted(list(cols))}")
+@schema_sql
+def _roll_insert_cols(cur):
+    """
+    Columnas de un INSERT en rolls para el esquema actual: roll_id, paper, warehouse,
+    luego cada columna de peso y cada columna de ubicacion. Devuelve (cols, n_peso, n_ubicacion).
+    """
+    rs = rolls_schema(cur)
+    return ("roll_id", rs.paper_col, rs.wh_col) + rs.weight_cols + rs.loc_cols, len(rs.weight_cols), len(rs.loc_cols)
 
-    weight_expr = "COALESCE(weight_lbs, weight)" if ("weight_lbs" in cols and "weight" in cols) else weight_cols[0]
-    loc_expr = "COALESCE(location, sublocation)" if ("location" in cols and "sublocation" in cols) else loc_cols[0]
 
-    cur.execute(
+def safe_insert_roll(cur, roll_id: str, paper_type: str, weight: int, warehouse: str, location: str,
+                     action: str = None):
+    """
+    Inserta un roll si su roll_id no existe (ON CONFLICT DO NOTHING) y devuelve True si entro.
+    Con action, el movimiento se registra en el mismo statement, solo para la fila insertada.
+    """
+    insert_cols, n_weight, n_loc = _roll_insert_cols(cur)
+    wh_col, loc_col = insert_cols[2], insert_cols[3 + n_weight]
+    insert_vals = ["%s"] * len(insert_cols)
+    params = [roll_id, paper_type, warehouse] + [weight] * n_weight + [location] * n_loc
+
+    q = (
+        f"INSERT INTO rolls ({', '.join(insert_cols)}) VALUES ({', '.join(insert_vals)}) "
+        "ON CONFLICT (roll_id) DO NOTHING"
+    )
+
+    mv = _with_movement(cur, "ins", action)
+    if not mv:
+        execute_prepared(cur, q + " RETURNING roll_id", tuple(params))
+        return cur.fetchone() is not None
+
+    params.append(action)
+    execute_prepared(
+        cur,
         f"""
-        SELECT roll_id,
-               {paper_col} AS paper_type,
-               {weight_expr} AS weight,
-               {wh_col} AS warehouse,
-               {loc_expr} AS location
-        FROM rolls
-        WHERE roll_id=%s
+        WITH ins AS (
+            {q}
+            RETURNING roll_id, %s AS action,
+                      {wh_col} AS from_wh, {wh_col} AS to_wh,
+                      {loc_col} AS from_loc, {loc_col} AS to_loc
+        ){mv}
+        SELECT roll_id FROM ins
         """,
-        (roll_id,),
+        tuple(params),
     )
-    return cur.fetchone()
+    return cur.fetchone() is not None
 
 
-def safe_insert_roll(cur, roll_id: str, paper_type: str, weight: int, warehouse: str, location: str):
-    cols = get_table_cols(cur, "rolls")
-    paper_col, wh_col, weight_cols, loc_cols, _ = rolls_columns(cols)
+def safe_insert_rolls(cur, rows, paper_type: str, warehouse: str, location: str, action: str = None):
+    """
+    Inserta muchos rolls (pares (roll_id, weight)) con INSERT multi-VALUES por paginas,
+    saltando los roll_id que ya existen. Devuelve el set de roll_id insertados; con action,
+    sus movimientos se registran con un solo COPY.
+    """
+    rows = list(rows)
+    if not rows:
+        return set()
 
-    if not paper_col or not wh_col or not weight_cols or not loc_cols:
-        raise RuntimeError(f"rolls schema unsupported. cols={sorted(list(cols))}")
+    insert_cols, n_weight, n_loc = _roll_insert_cols(cur)
+    inserted = psycopg2.extras.execute_values(
+        cur,
+        f"INSERT INTO rolls ({', '.join(insert_cols)}) VALUES %s "
+        "ON CONFLICT (roll_id) DO NOTHING RETURNING roll_id",
+        [
+            (roll_id, paper_type, warehouse) + (weight,) * n_weight + (location,) * n_loc
+            for roll_id, weight in rows
+        ],
+        page_size=BATCH_PAGE_SIZE,
+        fetch=True,
+    )
+    inserted = {row[0] for row in inserted}
 
-    insert_cols = ["roll_id", paper_col, wh_col]
-    insert_vals = ["%s", "%s", "%s"]
-    params = [roll_id, paper_type, warehouse]
+    if action:
+        log_movements(cur, [
+            {
+                "roll_id": roll_id,
+                "action": action,
+                "from_wh": warehouse,
+                "to_wh": warehouse,
+                "from_loc": location,
+                "to_loc": location,
+            }
+            for roll_id, _ in rows
+            if roll_id in inserted
+        ])
 
-    for wc in weight_cols:
-        insert_cols.append(wc)
-        insert_vals.append("%s")
-        params.append(weight)
+    return inserted
 
-    for lc in loc_cols:
-        insert_cols.append(lc)
-        insert_vals.append("%s")
-        params.append(location)
 
-    q = f"INSERT INTO rolls ({', '.join(insert_cols)}) VALUES ({', '.join(insert_vals)})"
-    cur.execute(q, tuple(params))
+@schema_sql
+def _location_set_clause(cur) -> str:
+    rs = rolls_schema(cur)
+    return ", ".join([f"{rs.wh_col}=%s"] + [f"{lc}=%s" for lc in rs.loc_cols])
 
 
-def safe_update_roll_location(cur, roll_id: str, new_wh: str, new_loc: str):
-    cols = get_table_cols(cur, "rolls")
-    _, wh_col, _, loc_cols, _ = rolls_columns(cols)
+def _location_set_sql(cur, new_wh: str, new_loc: str):
+    params = [new_wh] + [new_loc] * len(rolls_schema(cur).loc_cols)
+    return _location_set_clause(cur), params
 
-    set_sql = []
-    params = []
 
-    if wh_col:
-        set_sql.append(f"{wh_col}=%s")
-        params.append(new_wh)
+def safe_update_rolls_location(cur, roll_ids, new_wh: str, new_loc: str):
+    if not roll_ids:
+        return
+    roll_ids = list(roll_ids)
+    set_sql, params = _location_set_sql(cur, new_wh, new_loc)
 
-    for lc in loc_cols:
-        set_sql.append(f"{lc}=%s")
-        params.append(new_loc)
+    if len(roll_ids) > BATCH_PAGE_SIZE:
+        # execute_values solo acepta el placeholder del VALUES: el SET va ya interpolado
+        set_sql = cur.mogrify(set_sql, params).decode().replace("%", "%%")
+        psycopg2.extras.execute_values(
+            cur,
+            f"UPDATE rolls SET {set_sql} WHERE {_IDS_VALUES_WHERE}",
+            [(rid,) for rid in roll_ids],
+            page_size=len(roll_ids),
+        )
+        return
 
-    params.append(roll_id)
-    cur.execute(f"UPDATE rolls SET {', '.join(set_sql)} WHERE roll_id=%s", tuple(params))
+    params.append(roll_ids)
+    cur.execute(f"UPDATE rolls SET {set_sql} WHERE roll_id = ANY(%s)", tuple(params))
+
+
+@schema_sql
+def _update_returning_old_sql(cur, set_sql: str, guarded: bool, logged: bool) -> str:
+    guard = " AND old.warehouse=%s" if guarded else ""
+    return f"""
+        WITH old AS (
+            {_select_rolls_sql(cur, "roll_id=%s")}
+            FOR NO KEY UPDATE
+        ),
+        upd AS (
+            UPDATE rolls SET {set_sql}
+            FROM old
+            WHERE rolls.roll_id = old.roll_id{guard}
+            RETURNING rolls.roll_id, %s AS action,
+                      old.warehouse AS from_wh, %s AS to_wh,
+                      old.location AS from_loc, %s AS to_loc
+        ){_with_movement(cur, "upd", logged)}
+        SELECT old.*, EXISTS (SELECT 1 FROM upd) AS moved
+        FROM old
+        """
 
 
-def safe_update_roll_full(cur, roll_id: str, paper_type: str, weight: int, new_wh: str, new_loc: str):
-    cols = get_table_cols(cur, "rolls")
-    paper_col, wh_col, weight_cols, loc_cols, _ = rolls_columns(cols)
+def _update_roll_returning_old(cur, roll_id: str, set_sql: str, set_params, new_wh: str, new_loc: str,
+                               action: str = None, from_wh: str = None):
+    params = [roll_id, *set_params]
+    if from_wh:
+        params.append(from_wh)
+    params.extend([action, new_wh, new_loc])
+
+    execute_prepared(
+        cur,
+        _update_returning_old_sql(cur, set_sql, bool(from_wh), bool(action)),
+        tuple(params),
+    )
+    return cur.fetchone()
+
 
-    set_sql = []
-    params = []
+def safe_move_roll(cur, roll_id: str, new_wh: str, new_loc: str, from_wh: str = None, action: str = None):
+    """
+    Mueve un roll y devuelve como estaba antes, en un solo round-trip.
+    Devuelve None si el roll no existe. Con from_wh, un roll que esta en otra
+    bodega no se mueve y la fila devuelta trae moved=False.
+    Con action, el movimiento se registra en el mismo statement.
+    """
+    set_sql, params = _location_set_sql(cur, new_wh, new_loc)
+    return _update_roll_returning_old(cur, roll_id, set_sql, params, new_wh, new_loc,
+                                      action=action, from_wh=from_wh)
+
+
+@schema_sql
+def _delete_roll_sql(cur, logged: bool):
+    """(sql, lleva_action): sin columnas en movements el DELETE va solo, sin parametro de action."""
+    mv = _with_movement(cur, "src", logged)
+    if not mv:
+        return f"DELETE FROM rolls WHERE roll_id=%s RETURNING {_roll_fields_sql(cur)}", False
+
+    return f"""
+        WITH del AS (
+            DELETE FROM rolls WHERE roll_id=%s RETURNING {_roll_fields_sql(cur)}
+        ),
+        src AS (
+            SELECT roll_id, %s AS action,
+                   warehouse AS from_wh, warehouse AS to_wh,
+                   location AS from_loc, location AS to_loc
+            FROM del
+        ){mv}
+        SELECT * FROM del
+        """, True
+
+
+def safe_delete_roll(cur, roll_id: str, action: str = None):
+    sql, with_action = _delete_roll_sql(cur, bool(action))
+    execute_prepared(cur, sql, (roll_id, action) if with_action else (roll_id,))
+    return cur.fetchone()
 
-    set_sql.append(f"{paper_col}=%s")
-    params.append(paper_type)
 
-    if wh_col:
-        set_sql.append(f"{wh_col}=%s")
-        params.append(new_wh)
+@schema_sql
+def _full_set_clause(cur) -> str:
+    rs = rolls_schema(cur)
+    return ", ".join(
+        [f"{rs.paper_col}=%s", f"{rs.wh_col}=%s"]
+        + [f"{wc}=COALESCE(%s, old.weight)" for wc in rs.weight_cols]
+        + [f"{lc}=%s" for lc in rs.loc_cols]
+    )
 
-    for wc in weight_cols:
-        set_sql.append(f"{wc}=%s")
-        params.append(weight)
 
-    for lc in loc_cols:
-        set_sql.append(f"{lc}=%s")
-        params.append(new_loc)
+def safe_update_roll_full(cur, roll_id: str, paper_type: str, weight: int, new_wh: str, new_loc: str,
+                          action: str = None):
+    """
+    Actualiza todos los campos del roll y devuelve la fila anterior (None si no existe).
+    weight=None conserva el peso actual.
+    """
+    rs = rolls_schema(cur)
+    params = [paper_type, new_wh] + [weight] * len(rs.weight_cols) + [new_loc] * len(rs.loc_cols)
+    return _update_roll_returning_old(cur, roll_id, _full_set_clause(cur), params, new_wh, new_loc, action=action)
 
-    params.append(roll_id)
-    cur.execute(f"UPDATE rolls SET {', '.join(set_sql)} WHERE roll_id=%s", tuple(params))
 
+def _schema_version(conn, cur):
+    """Version registrada en schema_meta, o None si la tabla todavia no existe."""
+    try:
+        cur.execute("SELECT MAX(version) FROM schema_meta;")
+        return cur.fetchone()[0]
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        return None
 
-def init_db():
-    conn = get_conn()
-    cur = conn.cursor()
+
+def _migrate_schema(cur):
+    """
+    DDL + backfills de init_db, dentro de la transaccion de la migracion.
+    Devuelve los indices a crear (nombre, "tabla (columnas)"): esos van despues,
+    con CONCURRENTLY, que no se puede correr dentro de una transaccion.
+    """
+    indexes = []
 
     cur.execute(
         """
@@ -481,24 +1114,35 @@ def init_db():
     if not col_exists(cur, "rolls", "location") and not col_exists(cur, "rolls", "sublocation"):
         cur.execute("ALTER TABLE rolls ADD COLUMN location TEXT;")
 
+    forget_table_cols("rolls")
     cols = get_table_cols(cur, "rolls")
     _, _, weight_cols, loc_cols, _ = rolls_columns(cols)
 
-    cur.execute("UPDATE rolls SET warehouse='WH1' WHERE warehouse IS NULL;")
-    for wc in weight_cols:
-        cur.execute(f"UPDATE rolls SET {wc}=1 WHERE {wc} IS NULL;")
-
-    for lc in loc_cols:
-        cur.execute(f"UPDATE rolls SET {lc}='01' WHERE {lc} IS NULL AND warehouse='WH1';")
-        cur.execute(f"UPDATE rolls SET {lc}='21' WHERE {lc} IS NULL AND warehouse='WH2';")
-        cur.execute(f"UPDATE rolls SET {lc}='USED' WHERE {lc} IS NULL AND warehouse='USED';")
-        cur.execute(f"UPDATE rolls SET {lc}=COALESCE({lc}, '02') WHERE {lc} IS NULL;")
-
-    cur.execute("ALTER TABLE rolls ALTER COLUMN warehouse SET NOT NULL;")
-    for wc in weight_cols:
-        cur.execute(f"ALTER TABLE rolls ALTER COLUMN {wc} SET NOT NULL;")
-    for lc in loc_cols:
-        cur.execute(f"ALTER TABLE rolls ALTER COLUMN {lc} SET NOT NULL;")
+    # Un solo UPDATE rellena todos los NULL (la ubicacion por defecto depende de la bodega,
+    # que puede venir NULL y quedar en WH1 en esta misma pasada) y un solo ALTER valida
+    # todos los NOT NULL, en vez de una pasada por la tabla por cada columna.
+    wh_filled = "COALESCE(warehouse, 'WH1')"
+    fill = ["warehouse=" + wh_filled]
+    fill += [f"{wc}=COALESCE({wc}, 1)" for wc in weight_cols]
+    fill += [
+        f"""{lc}=COALESCE({lc}, CASE {wh_filled}
+                                 WHEN 'WH1' THEN '01'
+                                 WHEN 'WH2' THEN '21'
+                                 WHEN 'USED' THEN 'USED'
+                                 ELSE '02'
+                               END)"""
+        for lc in loc_cols
+    ]
+    nullable = ["warehouse"] + weight_cols + loc_cols
+    cur.execute(
+        f"UPDATE rolls SET {', '.join(fill)} "
+        f"WHERE {' OR '.join(f'{c} IS NULL' for c in nullable)};"
+    )
+    cur.execute(
+        "ALTER TABLE rolls "
+        + ", ".join(f"ALTER COLUMN {c} SET NOT NULL" for c in nullable)
+        + ";"
+    )
 
     cur.execute(
         """
@@ -507,23 +1151,50 @@ def init_db():
           IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname='rolls_location_check') THEN
             ALTER TABLE rolls DROP CONSTRAINT rolls_location_check;
           END IF;
+          IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname='rolls_wh_check') THEN
+            ALTER TABLE rolls DROP CONSTRAINT rolls_wh_check;
+          END IF;
+          ALTER TABLE rolls
+            ADD CONSTRAINT rolls_wh_check
+            CHECK (warehouse IN ('WH1','WH2','USED'));
         END $$;
         """
     )
 
+    # Indices para /inventory (filtra por warehouse) y /search (filtra por paper_type)
+    paper_col, wh_col, _, _, _ = rolls_columns(cols)
+    # INCLUDE del peso (y la ubicacion legacy): /inventory lee todo de un index-only scan
+    extra_cols = ", ".join(weight_cols + loc_cols[1:])
+    indexes.append((
+        "rolls_wh_paper_loc_id_w",
+        f"rolls ({wh_col}, {paper_col}, {loc_cols[0]}, roll_id) INCLUDE ({extra_cols})",
+    ))
+    indexes.append(("rolls_paper_wh", f"rolls ({paper_col}, {wh_col})"))
+
+    # pg_trgm es opcional: si el servidor no lo tiene, /search sigue funcionando con seq scan
     cur.execute(
         """
         DO $$
         BEGIN
-          IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname='rolls_wh_check') THEN
-            ALTER TABLE rolls DROP CONSTRAINT rolls_wh_check;
-          END IF;
-          ALTER TABLE rolls
-            ADD CONSTRAINT rolls_wh_check
-            CHECK (warehouse IN ('WH1','WH2','USED'));
+          CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        EXCEPTION WHEN OTHERS THEN
+          RAISE NOTICE 'pg_trgm not available: %', SQLERRM;
         END $$;
         """
     )
+    cur.execute("SELECT 1 FROM pg_extension WHERE extname='pg_trgm';")
+    if cur.fetchone():
+        indexes.append(("rolls_paper_trgm", f"rolls USING gin ({paper_col} gin_trgm_ops)"))
+
+    # Full text para busquedas de varias palabras en /search (ver paper_tsvector_sql)
+    indexes.append(("rolls_paper_fts", f"rolls USING gin ({paper_tsvector_sql(paper_col)})"))
+
+    # Los ETag de /inventory salen del contenido (md5 en _fetch_inventory); se borra el contador
+    # global que usaban antes, que serializaba a todos los writers de rolls en una fila.
+    cur.execute("DROP TRIGGER IF EXISTS rolls_version_bump ON rolls;")
+    cur.execute("DROP FUNCTION IF EXISTS bump_rolls_version();")
+    cur.execute("DROP TABLE IF EXISTS rolls_version;")
+    cur.execute("DROP SEQUENCE IF EXISTS rolls_version_seq;")
 
     cur.execute("CREATE TABLE IF NOT EXISTS movements (id BIGSERIAL PRIMARY KEY);")
     for col, ddl in [
@@ -539,6 +1210,7 @@ def init_db():
         if not col_exists(cur, "movements", col):
             cur.execute(ddl)
 
+    forget_table_cols("movements")
     mcols = get_table_cols(cur, "movements")
     if "ts_utc" in mcols:
         cur.execute("UPDATE movements SET ts_utc=NOW() WHERE ts_utc IS NULL;")
@@ -547,6 +1219,11 @@ def init_db():
         cur.execute("UPDATE movements SET moved_at=NOW() WHERE moved_at IS NULL;")
         cur.execute("ALTER TABLE movements ALTER COLUMN moved_at SET DEFAULT NOW();")
 
+    ts_col = "ts_utc" if "ts_utc" in mcols else "moved_at"
+    indexes.append(("movements_roll_ts", f"movements (roll_id, {ts_col} DESC)"))
+    # auditorias por tipo de movimiento ("todos los BATCH_REMOVE_TO_USED de la semana")
+    indexes.append(("movements_action_ts", f"movements (action, {ts_col} DESC)"))
+
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS envelope_inventory (
@@ -570,73 +1247,241 @@ def init_db():
         );
         """
     )
-        
-    conn.commit()
-    cur.close()
-    conn.close()
-
-@app.before_request
-def _ensure_db():
-    if not getattr(app, "_db_ready", False):
-        init_db()
-        app._db_ready = True
 
+    # Detalle/reprint filtran por tipo y ordenan por pallet_id; /envelopes/used filtra por status.
+    # El indice text_pattern_ops sirve al LIKE 'PREFIJO-%' con que se numeran los pallets nuevos.
+    indexes.append(("envelope_pallets_type_pallet", "envelope_pallets (envelope_type, pallet_id)"))
+    indexes.append(("envelope_pallets_status_type", "envelope_pallets (status, envelope_type, pallet_id)"))
+    indexes.append(("envelope_pallets_pallet_pattern", "envelope_pallets (pallet_id text_pattern_ops)"))
 
-def require_login(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        if not session.get("logged_in"):
-            return redirect(url_for("login"))
-        return f(*args, **kwargs)
-    return wrapper
+    return indexes
 
-def current_role():
-    return session.get("role", "")
 
-def can_write():
-    return current_role() == "admin"
+# Indices reemplazados por otros de _migrate_schema; se borran una vez creados los nuevos
+RETIRED_INDEXES = ("rolls_wh_paper_loc_id",)
 
-def is_guest():
-    return current_role() == "guest"
 
-app.jinja_env.globals["can_write"] = can_write
-app.jinja_env.globals["is_guest"] = is_guest
-app.jinja_env.globals["current_role"] = current_role
+def _create_indexes_concurrently(conn, cur, indexes):
+    """
+    CREATE INDEX CONCURRENTLY no bloquea escrituras, pero exige autocommit.
+    Si un intento anterior fallo a medias queda un indice INVALID que IF NOT EXISTS
+    no reconstruiria, asi que ese se borra primero.
+    """
+    conn.autocommit = True
+    try:
+        for name, target in indexes:
+            cur.execute(
+                """
+                SELECT i.indisvalid
+                FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = %s
+                """,
+                (name,),
+            )
+            row = cur.fetchone()
+            if row and not row[0]:
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+            cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {target};")
+        for name in RETIRED_INDEXES:
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+    finally:
+        conn.autocommit = False
 
-def require_write(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        if not session.get("logged_in"):
-            return redirect(url_for("login"))
 
-        if not can_write():
+def init_db():
+    forget_table_cols()
+
+    with get_conn() as conn, conn.cursor() as cur:
+        # Camino rapido: el esquema ya esta al dia, no hace falta ningun DDL
+        if _schema_version(conn, cur) == SCHEMA_VERSION:
+            conn.rollback()
+            get_table_cols(cur, "rolls")
+            get_table_cols(cur, "movements")
+            return
+
+        # Serializa la migracion entre workers de gunicorn que arrancan a la vez. Es un lock
+        # de sesion (no de transaccion) porque los indices se crean despues del COMMIT.
+        # El que espera no puede retener un snapshot: el CREATE INDEX CONCURRENTLY del que
+        # tiene el lock lo esperaria a el (deadlock). Por eso se espera en autocommit y con
+        # pg_try_advisory_lock, ya que un pg_advisory_lock bloqueado tambien tiene snapshot.
+        # Solo _migrate_schema corre dentro de una transaccion.
+        conn.rollback()
+        conn.autocommit = True
+        while True:
+            cur.execute("SELECT pg_try_advisory_lock(%s);", (SCHEMA_LOCK_ID,))
+            if cur.fetchone()[0]:
+                break
+            time.sleep(SCHEMA_LOCK_POLL)
+        try:
+            cur.execute("CREATE TABLE IF NOT EXISTS schema_meta (version INT PRIMARY KEY);")
+
+            if _schema_version(conn, cur) != SCHEMA_VERSION:
+                conn.autocommit = False
+                indexes = _migrate_schema(cur)
+                conn.commit()
+
+                _create_indexes_concurrently(conn, cur, indexes)
+
+                # la version se registra al final: si algo falla antes, el proximo arranque reintenta
+                conn.autocommit = True
+                cur.execute(
+                    "INSERT INTO schema_meta (version) VALUES (%s) ON CONFLICT (version) DO NOTHING;",
+                    (SCHEMA_VERSION,),
+                )
+        finally:
+            # si la conexion murio, el lock de sesion murio con ella
+            if not conn.closed:
+                conn.rollback()
+                conn.autocommit = True
+                cur.execute("SELECT pg_advisory_unlock(%s);", (SCHEMA_LOCK_ID,))
+                conn.autocommit = False
+
+        # recargar la cache con el esquema ya confirmado
+        forget_table_cols()
+        get_table_cols(cur, "rolls")
+        get_table_cols(cur, "movements")
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Crea/migra el esquema: flask --app app init-db"""
+    init_db()
+    print("Database schema is up to date.")
+
+
+# El login vive en su propia cookie firmada ("rol.emitido.firma"), no en la session de Flask:
+# verificarla es un HMAC, sin itsdangerous ni JSON, y la session queda solo para flashes.
+# La firma cubre la hora de emision, asi que cada login da un token distinto que vence solo.
+AUTH_COOKIE = "auth"
+AUTH_ROLES = ("admin", "guest")
+
+
+def _auth_sig(role: str, issued: str) -> str:
+    msg = f"{role}.{issued}".encode()
+    return hmac.new(app.secret_key.encode(), msg, hashlib.sha256).hexdigest()[:32]
+
+
+def _auth_token(role: str) -> str:
+    issued = str(int(time.time()))
+    return f"{role}.{issued}.{_auth_sig(role, issued)}"
+
+
+def _role_from_token(token: str) -> str:
+    parts = token.split(".")
+    if len(parts) != 3:
+        return ""
+    role, issued, sig = parts
+    # isdigit() solo acepta tambien digitos Unicode ("²") que int() rechaza, y compare_digest
+    # no acepta str no ASCII: una cookie forjada asi no puede terminar en un 500
+    if role not in AUTH_ROLES or not (issued.isascii() and issued.isdigit()) or not sig.isascii():
+        return ""
+    if not 0 <= time.time() - int(issued) <= AUTH_MAX_AGE:
+        return ""
+    return role if hmac.compare_digest(sig, _auth_sig(role, issued)) else ""
+
+
+def current_role():
+    if "role" not in g:
+        g.role = _role_from_token(request.cookies.get(AUTH_COOKIE, ""))
+    return g.role
+
+def is_logged_in():
+    return current_role() != ""
+
+def require_login(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not is_logged_in():
+            return redirect(url_for("login"))
+        return f(*args, **kwargs)
+    return wrapper
+
+def can_write():
+    return current_role() == "admin"
+
+def is_guest():
+    return current_role() == "guest"
+
+app.jinja_env.globals["can_write"] = can_write
+app.jinja_env.globals["is_guest"] = is_guest
+app.jinja_env.globals["current_role"] = current_role
+app.jinja_env.globals["is_logged_in"] = is_logged_in
+
+def require_write(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not is_logged_in():
+            return redirect(url_for("login"))
+
+        if not can_write():
             flash("Read-only account. You do not have permission to modify inventory.", "error")
             return redirect(url_for("home"))
 
         return f(*args, **kwargs)
     return wrapper
 
+def has_pending_flashes() -> bool:
+    return bool(session.get("_flashes"))
+
+
+# (path, rol) -> HTML. Solo para GETs cuyo contenido depende de la URL y del rol.
+_STATIC_PAGES = {}
+
+
+def render_static(template: str, **context):
+    """
+    render_template memoizado por worker para formularios/menus estaticos.
+    Con flashes pendientes se renderiza normal (y no se guarda): el HTML los incluye.
+    """
+    if has_pending_flashes():
+        return render_template(template, **context)
+
+    key = (request.path, current_role())
+    html = _STATIC_PAGES.get(key)
+    if html is None:
+        html = render_template(template, **context)
+        _STATIC_PAGES[key] = html
+    return html
+
+def _login_as(role: str):
+    resp = redirect(url_for("home"))
+    resp.set_cookie(
+        AUTH_COOKIE, _auth_token(role),
+        max_age=AUTH_MAX_AGE, secure=AUTH_COOKIE_SECURE, httponly=True, samesite="Lax",
+    )
+    return resp
+
+def _credentials_digest(user: str, password: str) -> bytes:
+    return (
+        hashlib.blake2b(user.encode(), digest_size=32).digest()
+        + hashlib.blake2b(password.encode(), digest_size=32).digest()
+    )
+
+
+# Digests de usuario+clave calculados una vez; el login compara en tiempo constante
+_LOGIN_DIGESTS = (
+    ("admin", _credentials_digest(APP_USER, APP_PASS)),
+    ("guest", _credentials_digest(GUEST_USER, GUEST_PASS)),
+)
+
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "GET":
-        return render_template("login.html")
+        return render_static("login.html")
 
     u = clean(request.form.get("username"))
     p = clean(request.form.get("password"))
 
-    if u == APP_USER and p == APP_PASS:
-        session.clear()
-        session["logged_in"] = True
-        session["username"] = APP_USER
-        session["role"] = "admin"
-        return redirect(url_for("home"))
+    # se comparan todos los roles, sin cortar en el primero, para no filtrar nada por tiempo
+    digest = _credentials_digest(u, p)
+    role = None
+    for candidate, expected in _LOGIN_DIGESTS:
+        if hmac.compare_digest(digest, expected) and role is None:
+            role = candidate
 
-    if u == GUEST_USER and p == GUEST_PASS:
-        session.clear()
-        session["logged_in"] = True
-        session["username"] = GUEST_USER
-        session["role"] = "guest"
-        return redirect(url_for("home"))
+    if role:
+        return _login_as(role)
 
     flash("Invalid credentials.", "error")
     return redirect(url_for("login"))
@@ -645,51 +1490,48 @@ def login():
 @app.route("/logout")
 def logout():
     session.clear()
-    return redirect(url_for("login"))
+    resp = redirect(url_for("login"))
+    resp.delete_cookie(AUTH_COOKIE)
+    return resp
 
 
 @app.route("/")
 @require_login
 def home():
-    return render_template("module_selector.html")
+    return render_static("module_selector.html")
 
 
 @app.route("/rolls")
 @require_login
 def rolls_home():
-    return render_template("home.html")
+    return render_static("home.html")
 
 
 @app.route("/envelopes")
 @require_login
 def envelopes_home():
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    cur.execute(
-        """
-        SELECT
-            envelope_type,
-            pallet_count,
-            updated_at
-        FROM envelope_inventory
-        ORDER BY envelope_type
-        """
-    )
-    rows = cur.fetchall() or []
-
-    cur.execute(
-        """
-        SELECT
-            COUNT(*) AS item_count,
-            COALESCE(SUM(pallet_count), 0) AS total_pallets
-        FROM envelope_inventory
-        """
-    )
-    totals = cur.fetchone() or {"item_count": 0, "total_pallets": 0}
+    with get_conn(readonly=True) as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(
+            """
+            SELECT
+                envelope_type,
+                pallet_count,
+                updated_at
+            FROM envelope_inventory
+            ORDER BY envelope_type
+            """
+        )
+        rows = cur.fetchall() or []
 
-    cur.close()
-    conn.close()
+        cur.execute(
+            """
+            SELECT
+                COUNT(*) AS item_count,
+                COALESCE(SUM(pallet_count), 0) AS total_pallets
+            FROM envelope_inventory
+            """
+        )
+        totals = cur.fetchone() or {"item_count": 0, "total_pallets": 0}
 
     return render_template("envelopes_home.html", rows=rows, totals=totals)
 
@@ -698,7 +1540,7 @@ def envelopes_home():
 @require_write
 def add_envelope():
     if request.method == "GET":
-        return render_template("add_envelope.html")
+        return render_static("add_envelope.html")
 
     envelope_type = clean(request.form.get("envelope_type")).upper()
     pallet_raw = clean(request.form.get("pallet_count"))
@@ -717,43 +1559,27 @@ def add_envelope():
         flash("Pallet Count cannot be negative.", "error")
         return redirect(url_for("add_envelope"))
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    cur.execute(
-        """
-        SELECT id
-        FROM envelope_inventory
-        WHERE envelope_type = %s
-        """,
-        (envelope_type,),
-    )
-    existing = cur.fetchone()
-
-    if existing:
-        cur.execute(
-            """
-            UPDATE envelope_inventory
-            SET pallet_count = %s,
-                updated_at = NOW()
-            WHERE envelope_type = %s
-            """,
-            (pallet_count, envelope_type),
-        )
-        flash("Envelope inventory updated.", "success")
-    else:
+    with get_conn() as conn, conn.cursor() as cur:
+        # xmax = 0 solo en filas recien insertadas: distingue alta de actualizacion sin otro SELECT
         cur.execute(
             """
             INSERT INTO envelope_inventory (envelope_type, pallet_count)
             VALUES (%s, %s)
+            ON CONFLICT (envelope_type) DO UPDATE
+            SET pallet_count = EXCLUDED.pallet_count,
+                updated_at = NOW()
+            RETURNING (xmax = 0) AS inserted
             """,
             (envelope_type, pallet_count),
         )
-        flash("Envelope inventory added.", "success")
+        inserted = cur.fetchone()[0]
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
+
+    if inserted:
+        flash("Envelope inventory added.", "success")
+    else:
+        flash("Envelope inventory updated.", "success")
 
     return redirect(url_for("envelopes_home"))
 
@@ -762,7 +1588,7 @@ def add_envelope():
 @require_write
 def receive_envelopes():
     if request.method == "GET":
-        return render_template("receive_envelopes.html")
+        return render_static("receive_envelopes.html")
 
     envelope_type = clean(request.form.get("envelope_type")).upper()
     qty_raw = clean(request.form.get("quantity"))
@@ -781,37 +1607,19 @@ def receive_envelopes():
         flash("Quantity must be greater than 0.", "error")
         return redirect(url_for("receive_envelopes"))
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    cur.execute(
-        "SELECT pallet_count FROM envelope_inventory WHERE envelope_type=%s",
-        (envelope_type,)
-    )
-    row = cur.fetchone()
-
-    if row:
-        new_total = row["pallet_count"] + qty
-        cur.execute(
-            """
-            UPDATE envelope_inventory
-            SET pallet_count=%s, updated_at=NOW()
-            WHERE envelope_type=%s
-            """,
-            (new_total, envelope_type)
-        )
-    else:
+    with get_conn() as conn, conn.cursor() as cur:
         cur.execute(
             """
             INSERT INTO envelope_inventory (envelope_type, pallet_count)
             VALUES (%s, %s)
+            ON CONFLICT (envelope_type) DO UPDATE
+            SET pallet_count = envelope_inventory.pallet_count + EXCLUDED.pallet_count,
+                updated_at = NOW()
             """,
             (envelope_type, qty)
         )
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
 
     flash(f"Received {qty} pallet(s).", "success")
     return redirect(url_for("envelopes_home"))
@@ -821,7 +1629,7 @@ def receive_envelopes():
 @require_write
 def use_envelopes():
     if request.method == "GET":
-        return render_template("use_envelopes.html")
+        return render_static("use_envelopes.html")
 
     envelope_type = clean(request.form.get("envelope_type")).upper()
     qty_raw = clean(request.form.get("quantity"))
@@ -840,35 +1648,22 @@ def use_envelopes():
         flash("Quantity must be greater than 0.", "error")
         return redirect(url_for("use_envelopes"))
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    cur.execute(
-        "SELECT pallet_count FROM envelope_inventory WHERE envelope_type=%s",
-        (envelope_type,)
-    )
-    row = cur.fetchone()
-
-    if not row:
-        cur.close()
-        conn.close()
-        flash("Envelope type not found.", "error")
-        return redirect(url_for("use_envelopes"))
-
-    new_total = max(0, row["pallet_count"] - qty)
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE envelope_inventory
+            SET pallet_count=GREATEST(0, pallet_count - %s), updated_at=NOW()
+            WHERE envelope_type=%s
+            RETURNING pallet_count
+            """,
+            (qty, envelope_type)
+        )
 
-    cur.execute(
-        """
-        UPDATE envelope_inventory
-        SET pallet_count=%s, updated_at=NOW()
-        WHERE envelope_type=%s
-        """,
-        (new_total, envelope_type)
-    )
+        if not cur.fetchone():
+            flash("Envelope type not found.", "error")
+            return redirect(url_for("use_envelopes"))
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
 
     flash(f"Used {qty} pallet(s).", "success")
     return redirect(url_for("envelopes_home"))
@@ -878,112 +1673,70 @@ def use_envelopes():
 @require_write
 def edit_envelope_name():
     if request.method == "GET":
-        return render_template("edit_envelope_name.html")
+        return render_static("edit_envelope_name.html")
 
     mode = clean(request.form.get("mode")).lower()
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    with get_conn() as conn, conn.cursor() as cur:
+        if mode == "add":
+            new_name = clean(request.form.get("new_name")).upper()
 
-    if mode == "add":
-        new_name = clean(request.form.get("new_name")).upper()
+            if not new_name:
+                flash("New Envelope Type is required.", "error")
+                return redirect(url_for("edit_envelope_name"))
 
-        if not new_name:
-            cur.close()
-            conn.close()
-            flash("New Envelope Type is required.", "error")
-            return redirect(url_for("edit_envelope_name"))
+            cur.execute(
+                """
+                INSERT INTO envelope_inventory (envelope_type, pallet_count)
+                VALUES (%s, 0)
+                ON CONFLICT (envelope_type) DO NOTHING
+                RETURNING id
+                """,
+                (new_name,),
+            )
 
-        cur.execute(
-            "SELECT id FROM envelope_inventory WHERE envelope_type=%s",
-            (new_name,),
-        )
-        existing_new = cur.fetchone()
+            if cur.fetchone() is None:
+                flash("Envelope Type already exists.", "error")
+                return redirect(url_for("edit_envelope_name"))
 
-        if existing_new:
-            cur.close()
-            conn.close()
-            flash("Envelope Type already exists.", "error")
-            return redirect(url_for("edit_envelope_name"))
+            conn.commit()
 
-        cur.execute(
-            """
-            INSERT INTO envelope_inventory (envelope_type, pallet_count)
-            VALUES (%s, 0)
-            """,
-            (new_name,),
-        )
+            flash("Envelope type added.", "success")
+            return redirect(url_for("envelopes_home"))
 
-        conn.commit()
-        cur.close()
-        conn.close()
+        elif mode == "rename":
+            old_name = clean(request.form.get("old_name")).upper()
+            new_name = clean(request.form.get("rename_to")).upper()
 
-        flash("Envelope type added.", "success")
-        return redirect(url_for("envelopes_home"))
+            if not old_name or not new_name:
+                flash("Current Envelope Type and New Envelope Type are required.", "error")
+                return redirect(url_for("edit_envelope_name"))
 
-    elif mode == "rename":
-        old_name = clean(request.form.get("old_name")).upper()
-        new_name = clean(request.form.get("rename_to")).upper()
+            found, renamed = safe_rename_envelope_type(cur, old_name, new_name)
 
-        if not old_name or not new_name:
-            cur.close()
-            conn.close()
-            flash("Current Envelope Type and New Envelope Type are required.", "error")
-            return redirect(url_for("edit_envelope_name"))
+            if not found:
+                flash("Current Envelope Type not found.", "error")
+                return redirect(url_for("edit_envelope_name"))
 
-        cur.execute(
-            "SELECT id FROM envelope_inventory WHERE envelope_type=%s",
-            (old_name,),
-        )
-        existing_old = cur.fetchone()
+            if not renamed:
+                flash("New Envelope Type already exists.", "error")
+                return redirect(url_for("edit_envelope_name"))
 
-        if not existing_old:
-            cur.close()
-            conn.close()
-            flash("Current Envelope Type not found.", "error")
-            return redirect(url_for("edit_envelope_name"))
+            conn.commit()
 
-        cur.execute(
-            "SELECT id FROM envelope_inventory WHERE envelope_type=%s",
-            (new_name,),
-        )
-        existing_new = cur.fetchone()
+            flash("Envelope type name updated.", "success")
+            return redirect(url_for("envelopes_home"))
 
-        if existing_new:
-            cur.close()
-            conn.close()
-            flash("New Envelope Type already exists.", "error")
+        else:
+            flash("Invalid action.", "error")
             return redirect(url_for("edit_envelope_name"))
 
-        cur.execute(
-            """
-            UPDATE envelope_inventory
-            SET envelope_type=%s,
-                updated_at=NOW()
-            WHERE envelope_type=%s
-            """,
-            (new_name, old_name),
-        )
-
-        conn.commit()
-        cur.close()
-        conn.close()
-
-        flash("Envelope type name updated.", "success")
-        return redirect(url_for("envelopes_home"))
-
-    else:
-        cur.close()
-        conn.close()
-        flash("Invalid action.", "error")
-        return redirect(url_for("edit_envelope_name"))
-
 @app.route("/envelopes/generate", methods=["GET", "POST"])
 @require_login
 @require_write
 def generate_envelope_barcodes():
     if request.method == "GET":
-        return render_template("generate_envelope_barcodes.html")
+        return render_static("generate_envelope_barcodes.html")
 
     envelope_type_raw = request.form.get("envelope_type")
     qty_raw = clean(request.form.get("quantity"))
@@ -1004,60 +1757,38 @@ def generate_envelope_barcodes():
         flash("Quantity must be greater than 0.", "error")
         return redirect(url_for("generate_envelope_barcodes"))
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    cur.execute(
-        """
-        SELECT envelope_type
-        FROM envelope_inventory
-        WHERE envelope_type = %s
-        """,
-        (envelope_type,),
-    )
-    existing_type = cur.fetchone()
-
-    if not existing_type:
-        cur.close()
-        conn.close()
-        flash("Envelope Type does not exist. Please create it first in Manage Types.", "error")
-        return redirect(url_for("generate_envelope_barcodes"))
-
-    created_pallets = []
-    prefix = envelope_type_prefix(envelope_type)
-
-    for _ in range(qty):
-        pallet_id = next_envelope_pallet_id(cur, envelope_type)
-
+    with get_conn() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        # El UPDATE valida que el tipo exista y deja su fila lockeada mientras se numeran los pallets
         cur.execute(
             """
-            INSERT INTO envelope_pallets (pallet_id, envelope_type, type_prefix, status)
-            VALUES (%s, %s, %s, 'IN_STOCK')
+            UPDATE envelope_inventory
+            SET pallet_count = pallet_count + %s,
+                updated_at = NOW()
+            WHERE envelope_type = %s
+            RETURNING envelope_type
             """,
-            (pallet_id, envelope_type, prefix),
+            (qty, envelope_type),
         )
+        existing_type = cur.fetchone()
+
+        if not existing_type:
+            flash("Envelope Type does not exist. Please create it first in Manage Types.", "error")
+            return redirect(url_for("generate_envelope_barcodes"))
+
+        prefix = envelope_type_prefix(envelope_type)
+        pallet_ids = next_envelope_pallet_ids(cur, envelope_type, qty)
+        insert_envelope_pallets(cur, pallet_ids, envelope_type, prefix)
 
-        created_pallets.append(
+        created_pallets = [
             {
                 "pallet_id": pallet_id,
                 "envelope_type": envelope_type,
                 "type_prefix": prefix,
             }
-        )
-
-    cur.execute(
-        """
-        UPDATE envelope_inventory
-        SET pallet_count = pallet_count + %s,
-            updated_at = NOW()
-        WHERE envelope_type = %s
-        """,
-        (qty, envelope_type),
-    )
+            for pallet_id in pallet_ids
+        ]
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
 
     return render_template(
         "print_envelope_barcodes.html",
@@ -1072,50 +1803,31 @@ def update_envelope_quantity(envelope_type):
     envelope_type = clean(envelope_type).upper()
     action = clean(request.form.get("action"))
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    cur.execute(
-        """
-        SELECT pallet_count
-        FROM envelope_inventory
-        WHERE envelope_type = %s
-        """,
-        (envelope_type,),
-    )
-    row = cur.fetchone()
-
-    if not row:
-        cur.close()
-        conn.close()
-        flash("Envelope type not found.", "error")
-        return redirect(url_for("envelopes_home"))
-
-    current = row["pallet_count"]
-
     if action == "add":
-        new_value = current + 1
+        delta = 1
     elif action == "remove":
-        new_value = max(0, current - 1)
+        delta = -1
     else:
-        cur.close()
-        conn.close()
         flash("Invalid action.", "error")
         return redirect(url_for("envelopes_home"))
 
-    cur.execute(
-        """
-        UPDATE envelope_inventory
-        SET pallet_count = %s,
-            updated_at = NOW()
-        WHERE envelope_type = %s
-        """,
-        (new_value, envelope_type),
-    )
+    with get_conn() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(
+            """
+            UPDATE envelope_inventory
+            SET pallet_count = GREATEST(0, pallet_count + %s),
+                updated_at = NOW()
+            WHERE envelope_type = %s
+            RETURNING pallet_count
+            """,
+            (delta, envelope_type),
+        )
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        if not cur.fetchone():
+            flash("Envelope type not found.", "error")
+            return redirect(url_for("envelopes_home"))
+
+        conn.commit()
 
     return redirect(url_for("envelopes_home"))
 
@@ -1124,38 +1836,31 @@ def update_envelope_quantity(envelope_type):
 def envelope_type_detail(envelope_type):
     envelope_type = clean_envelope_name(envelope_type)
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    cur.execute(
-        """
-        SELECT envelope_type, pallet_count, updated_at
-        FROM envelope_inventory
-        WHERE envelope_type = %s
-        """,
-        (envelope_type,),
-    )
-    summary = cur.fetchone()
+    with get_conn(readonly=True) as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(
+            """
+            SELECT envelope_type, pallet_count, updated_at
+            FROM envelope_inventory
+            WHERE envelope_type = %s
+            """,
+            (envelope_type,),
+        )
+        summary = cur.fetchone()
 
-    if not summary:
-        cur.close()
-        conn.close()
-        flash("Envelope type not found.", "error")
-        return redirect(url_for("envelopes_home"))
+        if not summary:
+            flash("Envelope type not found.", "error")
+            return redirect(url_for("envelopes_home"))
 
-    cur.execute(
-        """
-        SELECT pallet_id, status, created_at
-        FROM envelope_pallets
-        WHERE envelope_type = %s
-        ORDER BY pallet_id
-        """,
-        (envelope_type,),
-    )
-    pallets = cur.fetchall() or []
-
-    cur.close()
-    conn.close()
+        cur.execute(
+            """
+            SELECT pallet_id, status, created_at
+            FROM envelope_pallets
+            WHERE envelope_type = %s
+            ORDER BY pallet_id
+            """,
+            (envelope_type,),
+        )
+        pallets = cur.fetchall() or []
 
     return render_template(
         "envelope_type_detail.html",
@@ -1175,58 +1880,18 @@ def rename_envelope_type(envelope_type):
         flash("New Envelope Type is required.", "error")
         return redirect(url_for("envelope_type_detail", envelope_type=old_name))
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    with get_conn() as conn, conn.cursor() as cur:
+        found, renamed = safe_rename_envelope_type(cur, old_name, new_name, envelope_type_prefix(new_name))
 
-    cur.execute(
-        "SELECT id FROM envelope_inventory WHERE envelope_type = %s",
-        (old_name,),
-    )
-    existing_old = cur.fetchone()
-
-    if not existing_old:
-        cur.close()
-        conn.close()
-        flash("Envelope type not found.", "error")
-        return redirect(url_for("envelopes_home"))
+        if not found:
+            flash("Envelope type not found.", "error")
+            return redirect(url_for("envelopes_home"))
 
-    cur.execute(
-        "SELECT id FROM envelope_inventory WHERE envelope_type = %s",
-        (new_name,),
-    )
-    existing_new = cur.fetchone()
+        if not renamed:
+            flash("That envelope type already exists.", "error")
+            return redirect(url_for("envelope_type_detail", envelope_type=old_name))
 
-    if existing_new:
-        cur.close()
-        conn.close()
-        flash("That envelope type already exists.", "error")
-        return redirect(url_for("envelope_type_detail", envelope_type=old_name))
-
-    new_prefix = envelope_type_prefix(new_name)
-
-    cur.execute(
-        """
-        UPDATE envelope_inventory
-        SET envelope_type = %s,
-            updated_at = NOW()
-        WHERE envelope_type = %s
-        """,
-        (new_name, old_name),
-    )
-
-    cur.execute(
-        """
-        UPDATE envelope_pallets
-        SET envelope_type = %s,
-            type_prefix = %s
-        WHERE envelope_type = %s
-        """,
-        (new_name, new_prefix, old_name),
-    )
-
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
 
     flash("Envelope type renamed.", "success")
     return redirect(url_for("envelope_type_detail", envelope_type=new_name))
@@ -1238,40 +1903,25 @@ def rename_envelope_type(envelope_type):
 def delete_envelope_type(envelope_type):
     envelope_type = clean_envelope_name(envelope_type)
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    cur.execute(
-        "SELECT id FROM envelope_inventory WHERE envelope_type = %s",
-        (envelope_type,),
-    )
-    in_summary = cur.fetchone()
-
-    cur.execute(
-        "SELECT COUNT(*) AS cnt FROM envelope_pallets WHERE envelope_type = %s",
-        (envelope_type,),
-    )
-    pallet_row = cur.fetchone()
-    pallet_count = pallet_row["cnt"] if pallet_row else 0
-
-    if not in_summary and pallet_count == 0:
-        cur.close()
-        conn.close()
-        flash("Envelope type not found.", "error")
-        return redirect(url_for("envelopes_home"))
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            WITH pallets AS (
+                DELETE FROM envelope_pallets WHERE envelope_type = %s RETURNING 1
+            ),
+            summary AS (
+                DELETE FROM envelope_inventory WHERE envelope_type = %s RETURNING 1
+            )
+            SELECT EXISTS (SELECT 1 FROM pallets) OR EXISTS (SELECT 1 FROM summary)
+            """,
+            (envelope_type, envelope_type),
+        )
 
-    cur.execute(
-        "DELETE FROM envelope_pallets WHERE envelope_type = %s",
-        (envelope_type,),
-    )
-    cur.execute(
-        "DELETE FROM envelope_inventory WHERE envelope_type = %s",
-        (envelope_type,),
-    )
+        if not cur.fetchone()[0]:
+            flash("Envelope type not found.", "error")
+            return redirect(url_for("envelopes_home"))
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
 
     flash("Envelope type removed.", "success")
     return redirect(url_for("envelopes_home"))
@@ -1282,59 +1932,39 @@ def delete_envelope_type(envelope_type):
 def backfill_envelope_type(envelope_type):
     envelope_type = clean_envelope_name(envelope_type)
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    cur.execute(
-        """
-        SELECT envelope_type, pallet_count
-        FROM envelope_inventory
-        WHERE envelope_type = %s
-        """,
-        (envelope_type,),
-    )
-    summary = cur.fetchone()
-
-    if not summary:
-        cur.close()
-        conn.close()
-        flash("Envelope type not found.", "error")
-        return redirect(url_for("envelopes_home"))
-
-    cur.execute(
-        """
-        SELECT COUNT(*) AS cnt
-        FROM envelope_pallets
-        WHERE envelope_type = %s
-          AND status = 'IN_STOCK'
-        """,
-        (envelope_type,),
-    )
-    row = cur.fetchone()
-    existing_count = row["cnt"] if row else 0
-
-    missing = max(0, summary["pallet_count"] - existing_count)
-    if missing == 0:
-        cur.close()
-        conn.close()
-        flash("No missing pallets to generate.", "success")
-        return redirect(url_for("envelope_type_detail", envelope_type=envelope_type))
-
-    prefix = envelope_type_prefix(envelope_type)
-
-    for _ in range(missing):
-        pallet_id = next_envelope_pallet_id(cur, envelope_type)
+    with get_conn() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
         cur.execute(
             """
-            INSERT INTO envelope_pallets (pallet_id, envelope_type, type_prefix, status)
-            VALUES (%s, %s, %s, 'IN_STOCK')
+            SELECT i.envelope_type,
+                   i.pallet_count,
+                   (
+                       SELECT COUNT(*)
+                       FROM envelope_pallets p
+                       WHERE p.envelope_type = i.envelope_type
+                         AND p.status = 'IN_STOCK'
+                   ) AS existing_count
+            FROM envelope_inventory i
+            WHERE i.envelope_type = %s
+            FOR UPDATE OF i
             """,
-            (pallet_id, envelope_type, prefix),
+            (envelope_type,),
         )
+        summary = cur.fetchone()
+
+        if not summary:
+            flash("Envelope type not found.", "error")
+            return redirect(url_for("envelopes_home"))
+
+        missing = max(0, summary["pallet_count"] - summary["existing_count"])
+        if missing == 0:
+            flash("No missing pallets to generate.", "success")
+            return redirect(url_for("envelope_type_detail", envelope_type=envelope_type))
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        prefix = envelope_type_prefix(envelope_type)
+        pallet_ids = next_envelope_pallet_ids(cur, envelope_type, missing)
+        insert_envelope_pallets(cur, pallet_ids, envelope_type, prefix)
+
+        conn.commit()
 
     flash(f"Generated {missing} missing pallet ID(s).", "success")
     return redirect(url_for("envelope_type_detail", envelope_type=envelope_type))
@@ -1345,22 +1975,17 @@ def backfill_envelope_type(envelope_type):
 def reprint_envelope_barcodes(envelope_type):
     envelope_type = clean_envelope_name(envelope_type)
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    cur.execute(
-        """
-        SELECT pallet_id, envelope_type, type_prefix
-        FROM envelope_pallets
-        WHERE envelope_type = %s
-        ORDER BY pallet_id
-        """,
-        (envelope_type,),
-    )
-    pallets = cur.fetchall() or []
-
-    cur.close()
-    conn.close()
+    with get_conn(readonly=True) as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(
+            """
+            SELECT pallet_id, envelope_type, type_prefix
+            FROM envelope_pallets
+            WHERE envelope_type = %s
+            ORDER BY pallet_id
+            """,
+            (envelope_type,),
+        )
+        pallets = cur.fetchall() or []
 
     if not pallets:
         flash("No pallets found for this envelope type.", "error")
@@ -1377,66 +2002,22 @@ def reprint_envelope_barcodes(envelope_type):
 @require_write
 def envelope_batch_remove():
     if request.method == "GET":
-        return render_template("envelope_batch_remove.html")
+        return render_static("envelope_batch_remove.html")
 
     raw = clean(request.form.get("pallet_ids"))
     if not raw:
         flash("Paste or scan pallet IDs first.", "error")
         return redirect(url_for("envelope_batch_remove"))
 
-    ids = [x.strip().upper() for x in re.split(r"[\s,;]+", raw) if x.strip()]
-    ids = list(dict.fromkeys(ids))
-
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    moved = 0
-    missing = []
-    already_used = []
-
-    for pid in ids:
-        cur.execute(
-            """
-            SELECT pallet_id, envelope_type, status
-            FROM envelope_pallets
-            WHERE pallet_id = %s
-            """,
-            (pid,),
-        )
-        pallet = cur.fetchone()
+    ids = parse_roll_ids_multiline(raw.upper())
 
-        if not pallet:
-            missing.append(pid)
-            continue
-
-        if pallet["status"] == "USED":
-            already_used.append(pid)
-            continue
-
-        cur.execute(
-            """
-            UPDATE envelope_pallets
-            SET status = 'USED'
-            WHERE pallet_id = %s
-            """,
-            (pid,),
-        )
-
-        cur.execute(
-            """
-            UPDATE envelope_inventory
-            SET pallet_count = GREATEST(0, pallet_count - 1),
-                updated_at = NOW()
-            WHERE envelope_type = %s
-            """,
-            (pallet["envelope_type"],),
-        )
-
-        moved += 1
+    with get_conn() as conn, conn.cursor() as cur:
+        changed = set_envelope_pallets_status(cur, ids, to_used=True)
+        conn.commit()
 
-    conn.commit()
-    cur.close()
-    conn.close()
+    moved = sum(changed.values())
+    missing = [pid for pid in ids if pid not in changed]
+    already_used = [pid for pid in ids if pid in changed and not changed[pid]]
 
     msg = f"Moved {moved} pallet(s) to USED."
     if missing:
@@ -1447,19 +2028,12 @@ def envelope_batch_remove():
     flash(msg, "success" if moved else "error")
     return redirect(url_for("envelope_batch_remove"))
 
-@app.route("/add/<warehouse>", methods=["GET", "POST"])
+@app.route('/add/<wh("WH1", "WH2"):warehouse>', methods=["GET", "POST"])
 @require_login
 @require_write
 def add_form(warehouse):
-    warehouse = clean(warehouse).upper()
-    if warehouse not in ("WH1", "WH2"):
-        flash("Invalid warehouse.", "error")
-        return redirect(url_for("home"))
-
-    locs = locations_for(warehouse)
-
     if request.method == "GET":
-        return render_template("add.html", warehouse=warehouse, locations=locs)
+        return render_static("add.html", warehouse=warehouse, locations=locations_for(warehouse))
 
     paper_type = clean(request.form.get("paper_type"))
     roll_id = clean(request.form.get("roll_id"))
@@ -1474,27 +2048,17 @@ def add_form(warehouse):
         flash("Invalid Roll ID: 4-digit numeric values are blocked to avoid scanning weight by mistake.", "error")
         return redirect(url_for("add_form", warehouse=warehouse))
 
-    if location not in locs:
+    if not is_valid_loc(warehouse, location):
         flash("Invalid Sub-Location.", "error")
         return redirect(url_for("add_form", warehouse=warehouse))
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    with get_conn() as conn, conn.cursor() as cur:
+        if not safe_insert_roll(cur, roll_id, paper_type, weight, warehouse, location, action=ACT_ADD):
+            conn.rollback()
+            flash("This Roll ID already exists.", "error")
+            return redirect(url_for("add_form", warehouse=warehouse))
 
-    cur.execute("SELECT 1 FROM rolls WHERE roll_id=%s", (roll_id,))
-    if cur.fetchone():
-        cur.close()
-        conn.close()
-        flash("This Roll ID already exists.", "error")
-        return redirect(url_for("add_form", warehouse=warehouse))
-
-    safe_insert_roll(cur, roll_id, paper_type, weight, warehouse, location)
-    log_movement(cur, roll_id=roll_id, action="ADD",
-                 from_wh=warehouse, to_wh=warehouse, from_loc=location, to_loc=location)
-
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
 
     flash("Roll added.", "success")
     return redirect(url_for("add_form", warehouse=warehouse))
@@ -1502,38 +2066,33 @@ def add_form(warehouse):
 @app.route("/envelopes/used")
 @require_login
 def envelopes_used_inventory():
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    cur.execute(
-        """
-        SELECT
-            envelope_type,
-            COUNT(*) AS cnt
-        FROM envelope_pallets
-        WHERE status = 'USED'
-        GROUP BY envelope_type
-        ORDER BY envelope_type
-        """
-    )
-    summary = cur.fetchall() or []
-
-    cur.execute(
-        """
-        SELECT
-            envelope_type,
-            pallet_id,
-            status,
-            created_at
-        FROM envelope_pallets
-        WHERE status = 'USED'
-        ORDER BY envelope_type, pallet_id
-        """
-    )
-    pallets = cur.fetchall() or []
+    with get_conn(readonly=True) as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(
+            """
+            SELECT
+                envelope_type,
+                COUNT(*) AS cnt
+            FROM envelope_pallets
+            WHERE status = 'USED'
+            GROUP BY envelope_type
+            ORDER BY envelope_type
+            """
+        )
+        summary = cur.fetchall() or []
 
-    cur.close()
-    conn.close()
+        cur.execute(
+            """
+            SELECT
+                envelope_type,
+                pallet_id,
+                status,
+                created_at
+            FROM envelope_pallets
+            WHERE status = 'USED'
+            ORDER BY envelope_type, pallet_id
+            """
+        )
+        pallets = cur.fetchall() or []
 
     return render_template(
         "envelopes_used.html",
@@ -1546,66 +2105,22 @@ def envelopes_used_inventory():
 @require_write
 def envelope_batch_return():
     if request.method == "GET":
-        return render_template("envelope_batch_return.html")
+        return render_static("envelope_batch_return.html")
 
     raw = clean(request.form.get("pallet_ids"))
     if not raw:
         flash("Paste or scan pallet IDs first.", "error")
         return redirect(url_for("envelope_batch_return"))
 
-    ids = [x.strip().upper() for x in re.split(r"[\s,;]+", raw) if x.strip()]
-    ids = list(dict.fromkeys(ids))
-
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    moved = 0
-    missing = []
-    not_used = []
-
-    for pid in ids:
-        cur.execute(
-            """
-            SELECT pallet_id, envelope_type, status
-            FROM envelope_pallets
-            WHERE pallet_id = %s
-            """,
-            (pid,),
-        )
-        pallet = cur.fetchone()
-
-        if not pallet:
-            missing.append(pid)
-            continue
-
-        if pallet["status"] != "USED":
-            not_used.append(pid)
-            continue
-
-        cur.execute(
-            """
-            UPDATE envelope_pallets
-            SET status = 'IN_STOCK'
-            WHERE pallet_id = %s
-            """,
-            (pid,),
-        )
-
-        cur.execute(
-            """
-            UPDATE envelope_inventory
-            SET pallet_count = pallet_count + 1,
-                updated_at = NOW()
-            WHERE envelope_type = %s
-            """,
-            (pallet["envelope_type"],),
-        )
+    ids = parse_roll_ids_multiline(raw.upper())
 
-        moved += 1
+    with get_conn() as conn, conn.cursor() as cur:
+        changed = set_envelope_pallets_status(cur, ids, to_used=False)
+        conn.commit()
 
-    conn.commit()
-    cur.close()
-    conn.close()
+    moved = sum(changed.values())
+    missing = [pid for pid in ids if pid not in changed]
+    not_used = [pid for pid in ids if pid in changed and not changed[pid]]
 
     msg = f"Returned {moved} pallet(s) to inventory."
     if missing:
@@ -1616,118 +2131,128 @@ def envelope_batch_return():
     flash(msg, "success" if moved else "error")
     return redirect(url_for("envelope_batch_return"))
 
-@app.route("/inventory/<warehouse>")
-@require_login
-def inventory(warehouse):
-    warehouse = clean(warehouse).upper()
-    if warehouse not in ALLOWED_WAREHOUSES:
-        flash("Invalid warehouse.", "error")
-        return redirect(url_for("home"))
-
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    cols = get_table_cols(cur, "rolls")
-    paper_col, wh_col, weight_cols, loc_cols, _ = rolls_columns(cols)
-
-    weight_expr = "COALESCE(weight_lbs, weight)" if ("weight_lbs" in cols and "weight" in cols) else weight_cols[0]
-    loc_expr = "COALESCE(location, sublocation)" if ("location" in cols and "sublocation" in cols) else loc_cols[0]
+def _fetch_inventory(cur, warehouse: str, known_digest: str = ""):
+    """
+    Una sola fila: Postgres arma la lista ya ordenada con json_agg y devuelve su md5.
+    Si el md5 es known_digest (lo que ya esta en cache) la lista no se manda: rows=None.
+    Devuelve (digest, rows, totals); digest, rows y totales salen del mismo snapshot.
+    """
+    rs = rolls_schema(cur)
+    paper_col, wh_col, weight_expr, loc_expr = rs.paper_col, rs.wh_col, rs.weight_expr, rs.loc_expr
 
-    cur.execute(
+    execute_prepared(
+        cur,
         f"""
-        SELECT roll_id,
-               {paper_col} AS paper_type,
-               {weight_expr} AS weight,
-               {loc_expr} AS location,
-               {wh_col} AS warehouse,
-               created_at
-        FROM rolls
-        WHERE {wh_col}=%s
-        ORDER BY 
-    CASE 
-        WHEN {loc_expr} ~ '^[0-9]+$' THEN CAST({loc_expr} AS INTEGER)
-        ELSE 999
-    END,
-    {paper_col},
-    roll_id
+        SELECT md5(t.rows),
+               CASE WHEN md5(t.rows) = %s THEN NULL ELSE t.rows END,
+               t.cnt,
+               t.total_weight
+        FROM (
+            SELECT
+                COALESCE(
+                    json_agg(
+                        json_build_object(
+                            'roll_id', roll_id,
+                            'paper_type', {paper_col},
+                            'weight', {weight_expr},
+                            'location', {loc_expr},
+                            'warehouse', {wh_col}
+                        )
+                        ORDER BY
+                            CASE
+                                WHEN {loc_expr} ~ '^[0-9]+$' THEN CAST({loc_expr} AS INTEGER)
+                                ELSE 999
+                            END,
+                            {paper_col},
+                            roll_id
+                    )::text,
+                    '[]'
+                ) AS rows,
+                COUNT(*) AS cnt,
+                COALESCE(SUM({weight_expr}), 0) AS total_weight
+            FROM rolls
+            WHERE {wh_col}=%s
+        ) t
         """,
-        (warehouse,),
+        (known_digest, warehouse),
     )
-    rows = cur.fetchall() or []
+    digest, rows, cnt, total_weight = cur.fetchone()
 
-    cur.execute(
-        f"""
-        SELECT COUNT(*) AS cnt, COALESCE(SUM({weight_expr}), 0) AS total_weight
-        FROM rolls
-        WHERE {wh_col}=%s
-        """,
-        (warehouse,),
-    )
-    totals = cur.fetchone() or {"cnt": 0, "total_weight": 0}
+    return digest, None if rows is None else json.loads(rows), {"cnt": cnt, "total_weight": total_weight}
 
-    cur.close()
-    conn.close()
-    return render_template("inventory.html", warehouse=warehouse, rows=rows, totals=totals)
 
-@app.route("/inventory-summary/<warehouse>")
-@require_login
-def inventory_summary(warehouse):
-    warehouse = clean(warehouse).upper()
-    if warehouse not in ALLOWED_WAREHOUSES:
-        flash("Invalid warehouse.", "error")
-        return redirect(url_for("home"))
+# warehouse -> (digest, rows); las filas solo viajan desde Postgres cuando cambia el md5
+_INVENTORY_CACHE = {}
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    cols = get_table_cols(cur, "rolls")
-    paper_col, wh_col, weight_cols, loc_cols, _ = rolls_columns(cols)
+def inventory_etag(digest: str, warehouse: str) -> str:
+    # La pagina depende del rol y del deploy
+    return f"{digest}-{warehouse}-{current_role()}-{ETAG_SALT}"
 
-    weight_expr = "COALESCE(weight_lbs, weight)" if ("weight_lbs" in cols and "weight" in cols) else weight_cols[0]
-    loc_expr = "COALESCE(location, sublocation)" if ("location" in cols and "sublocation" in cols) else loc_cols[0]
 
-    cur.execute(
-        f"""
-        SELECT
-            {loc_expr} AS location,
-            {paper_col} AS paper_type,
-            COUNT(*) AS cnt,
-            COALESCE(SUM({weight_expr}), 0) AS total_weight
-        FROM rolls
-        WHERE {wh_col} = %s
-        GROUP BY {loc_expr}, {paper_col}
-        ORDER BY
-            CASE
-                WHEN {loc_expr} ~ '^[0-9]+$' THEN CAST({loc_expr} AS INTEGER)
-                ELSE 999
-            END,
-            {paper_col}
-        """,
-        (warehouse,),
-    )
-    rows = cur.fetchall() or []
+@app.route("/inventory/<wh:warehouse>")
+@require_login
+def inventory(warehouse):
+    cached = _INVENTORY_CACHE.get(warehouse)
 
-    cur.execute(
-        f"""
-        SELECT
-            COUNT(DISTINCT {loc_expr}) AS row_count,
-            COUNT(DISTINCT {paper_col}) AS paper_type_count,
-            COUNT(*) AS roll_count,
-            COALESCE(SUM({weight_expr}), 0) AS total_weight
-        FROM rolls
-        WHERE {wh_col} = %s
-        """,
-        (warehouse,),
-    )
-    totals = cur.fetchone() or {
-        "row_count": 0,
-        "paper_type_count": 0,
-        "roll_count": 0,
-        "total_weight": 0,
-    }
+    with get_conn(readonly=True) as conn, conn.cursor() as cur:
+        digest, rows, totals = _fetch_inventory(cur, warehouse, cached[0] if cached else "")
+
+    if rows is None:
+        rows = cached[1]
+    else:
+        _INVENTORY_CACHE[warehouse] = (digest, rows)
+
+    # con flashes pendientes no se cachea
+    etag = inventory_etag(digest, warehouse)
+    cacheable = not has_pending_flashes()
+    matched = cacheable and matching_etag(etag)
+    if matched:
+        resp = app.response_class(status=304)
+        resp.headers["ETag"] = matched
+        return resp
+
+    resp = make_response(render_template("inventory.html", warehouse=warehouse, rows=rows, totals=totals))
+    if cacheable:
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+@app.route("/inventory-summary/<wh:warehouse>")
+@require_login
+def inventory_summary(warehouse):
+    with get_conn(readonly=True) as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        rs = rolls_schema(cur)
+        paper_col, wh_col, weight_expr, loc_expr = rs.paper_col, rs.wh_col, rs.weight_expr, rs.loc_expr
 
-    cur.close()
-    conn.close()
+        cur.execute(
+            f"""
+            SELECT
+                {loc_expr} AS location,
+                {paper_col} AS paper_type,
+                COUNT(*) AS cnt,
+                COALESCE(SUM({weight_expr}), 0) AS total_weight
+            FROM rolls
+            WHERE {wh_col} = %s
+            GROUP BY {loc_expr}, {paper_col}
+            ORDER BY
+                CASE
+                    WHEN {loc_expr} ~ '^[0-9]+$' THEN CAST({loc_expr} AS INTEGER)
+                    ELSE 999
+                END,
+                {paper_col}
+            """,
+            (warehouse,),
+        )
+        rows = cur.fetchall() or []
+
+    # Los totales salen de los mismos grupos (location, paper_type): sin segunda query
+    totals = {
+        "row_count": len({r["location"] for r in rows}),
+        "paper_type_count": len({r["paper_type"] for r in rows}),
+        "roll_count": sum(r["cnt"] for r in rows),
+        "total_weight": sum(r["total_weight"] for r in rows),
+    }
 
     return render_template(
         "inventory_summary.html",
@@ -1737,75 +2262,75 @@ def inventory_summary(warehouse):
     )
 
 
+def _load_roll(cur, roll_id: str):
+    """
+    Roll para edit.html (con los alias sublocation/weight_lbs), o None.
+    Usa un cursor de tuplas: es una sola fila y no vale la pena armar el dict por celda.
+    """
+    execute_prepared(cur, _select_rolls_sql(cur, "roll_id=%s"), (roll_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+
+    rid, paper_type, weight, warehouse, location = row
+    return {
+        "roll_id": rid,
+        "paper_type": paper_type,
+        "warehouse": warehouse,
+        "location": location,
+        "sublocation": location,
+        "weight": weight,
+        "weight_lbs": weight,
+    }
+
+
 @app.route("/edit/<roll_id>", methods=["GET", "POST"])
 @require_login
 @require_write
 def edit_roll_form(roll_id):
     roll_id = clean(roll_id)
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    db_roll = safe_select_roll(cur, roll_id)
-    if not db_roll:
-        cur.close()
-        conn.close()
-        flash("Roll ID not found.", "error")
-        return redirect(url_for("home"))
-
-    r = {
-        "roll_id": db_roll["roll_id"],
-        "paper_type": db_roll["paper_type"],
-        "warehouse": db_roll["warehouse"],
-        "location": db_roll["location"],
-        "sublocation": db_roll["location"],
-        "weight": db_roll["weight"],
-        "weight_lbs": db_roll["weight"],
-    }
-
     if request.method == "GET":
-        cur.close()
-        conn.close()
+        with get_conn(readonly=True) as conn, conn.cursor() as cur:
+            r = _load_roll(cur, roll_id)
+
+        if not r:
+            flash("Roll ID not found.", "error")
+            return redirect(url_for("home"))
+
         return render_template("edit.html", r=r, warehouses=list(ALLOWED_WAREHOUSES))
 
     new_wh = clean(request.form.get("warehouse")).upper()
     new_loc = read_form_location()
     new_paper = clean(request.form.get("paper_type"))
 
+    # Peso vacio = conservar el actual (lo resuelve el UPDATE con COALESCE)
     raw_weight = clean(request.form.get("weight") or request.form.get("weight_lbs") or "")
-    new_weight = db_roll["weight"] if raw_weight == "" else parse_weight(raw_weight)
+    new_weight = None if raw_weight == "" else parse_weight(raw_weight)
 
     if new_wh not in ALLOWED_WAREHOUSES:
-        cur.close()
-        conn.close()
         flash("Invalid warehouse.", "error")
         return redirect(url_for("edit_roll_form", roll_id=roll_id))
 
-    if not new_paper or new_weight is None:
-        cur.close()
-        conn.close()
+    if not new_paper or (raw_weight != "" and new_weight is None):
         flash("Paper Type is required. Weight must be a valid number.", "error")
         return redirect(url_for("edit_roll_form", roll_id=roll_id))
 
     if new_wh == "USED":
         new_loc = "USED"
     else:
-        if new_loc not in locations_for(new_wh):
-            cur.close()
-            conn.close()
+        if not is_valid_loc(new_wh, new_loc):
             flash("Invalid Sub-Location.", "error")
             return redirect(url_for("edit_roll_form", roll_id=roll_id))
 
-    old_wh = db_roll["warehouse"]
-    old_loc = db_roll["location"]
-
-    safe_update_roll_full(cur, roll_id, new_paper, new_weight, new_wh, new_loc)
-    log_movement(cur, roll_id=roll_id, action="EDIT_MOVE",
-                 from_wh=old_wh, to_wh=new_wh, from_loc=old_loc, to_loc=new_loc)
+    # cursor de tuplas: de la fila anterior solo importa si existe
+    with get_conn() as conn, conn.cursor() as cur:
+        old = safe_update_roll_full(cur, roll_id, new_paper, new_weight, new_wh, new_loc, action=ACT_EDIT_MOVE)
+        if not old:
+            flash("Roll ID not found.", "error")
+            return redirect(url_for("home"))
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
 
     flash("Updated.", "success")
     return redirect(url_for("inventory", warehouse=new_wh))
@@ -1814,17 +2339,10 @@ def edit_roll_form(roll_id):
 @require_login
 @require_write
 def clear_used_inventory():
-    conn = get_conn()
-    cur = conn.cursor()
-
-    cols = get_table_cols(cur, "rolls")
-    _, wh_col, _, _, _ = rolls_columns(cols)
-
-    cur.execute(f"DELETE FROM rolls WHERE {wh_col} = %s", ("USED",))
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute(f"DELETE FROM rolls WHERE {rolls_schema(cur).wh_col} = %s", ("USED",))
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
 
     flash("USED inventory cleared.", "success")
     return redirect(url_for("inventory", warehouse="USED"))
@@ -1835,36 +2353,18 @@ def clear_used_inventory():
 @require_write
 def to_used_pc(roll_id):
     roll_id = clean(roll_id)
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    r = safe_select_roll(cur, roll_id)
-    if not r:
-        cur.close()
-        conn.close()
-        if request.headers.get("X-Requested-With") == "XMLHttpRequest":
-            return {"ok": False, "error": "Roll ID not found."}, 404
-        flash("Roll ID not found.", "error")
-        return redirect(url_for("home"))
-
-    from_wh = r["warehouse"]
-    from_loc = r["location"]
-    moved_weight = r["weight"]
-
-    safe_update_roll_location(cur, roll_id, "USED", "USED")
-    log_movement(
-        cur,
-        roll_id=roll_id,
-        action="TO_USED_PC",
-        from_wh=from_wh,
-        to_wh="USED",
-        from_loc=from_loc,
-        to_loc="USED"
-    )
+    with get_conn() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        r = safe_move_roll(cur, roll_id, "USED", "USED", action=ACT_TO_USED_PC)
+        if not r:
+            if request.headers.get("X-Requested-With") == "XMLHttpRequest":
+                return {"ok": False, "error": "Roll ID not found."}, 404
+            flash("Roll ID not found.", "error")
+            return redirect(url_for("home"))
+
+        from_wh = r["warehouse"]
+        moved_weight = r["weight"]
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
 
     if request.headers.get("X-Requested-With") == "XMLHttpRequest":
         return {
@@ -1876,30 +2376,6 @@ def to_used_pc(roll_id):
 
     flash("Moved to USED.", "success")
     return redirect(url_for("inventory", warehouse=from_wh) + "#inventory-table")
-    roll_id = clean(roll_id)
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    r = safe_select_roll(cur, roll_id)
-    if not r:
-        cur.close()
-        conn.close()
-        flash("Roll ID not found.", "error")
-        return redirect(url_for("home"))
-
-    from_wh = r["warehouse"]
-    from_loc = r["location"]
-
-    safe_update_roll_location(cur, roll_id, "USED", "USED")
-    log_movement(cur, roll_id=roll_id, action="TO_USED_PC",
-                 from_wh=from_wh, to_wh="USED", from_loc=from_loc, to_loc="USED")
-
-    conn.commit()
-    cur.close()
-    conn.close()
-
-    flash("Moved to USED.", "success")
-    return redirect(url_for("inventory", warehouse=from_wh) + "#inventory-table")
 
 
 @app.route("/delete/<roll_id>", methods=["POST"])
@@ -1907,43 +2383,26 @@ def to_used_pc(roll_id):
 @require_write
 def delete_roll_pc(roll_id):
     roll_id = clean(roll_id)
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    r = safe_select_roll(cur, roll_id)
-    if not r:
-        cur.close()
-        conn.close()
-        flash("Roll ID not found.", "error")
-        return redirect(url_for("home"))
-
-    wh = r["warehouse"]
-    loc = r["location"]
+    with get_conn() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        r = safe_delete_roll(cur, roll_id, action=ACT_DELETE)
+        if not r:
+            flash("Roll ID not found.", "error")
+            return redirect(url_for("home"))
 
-    log_movement(cur, roll_id=roll_id, action="DELETE", from_wh=wh, to_wh=wh, from_loc=loc, to_loc=loc)
-    cur.execute("DELETE FROM rolls WHERE roll_id=%s", (roll_id,))
+        wh = r["warehouse"]
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
 
     flash("Deleted permanently.", "success")
     return redirect(url_for("inventory", warehouse=wh))
 
 
-@app.route("/transfer/<from_wh>/<to_wh>", methods=["GET", "POST"])
+@app.route('/transfer/<wh("WH1", "WH2"):from_wh>/<wh("WH1", "WH2"):to_wh>', methods=["GET", "POST"])
 @require_login
 @require_write
 def transfer_form(from_wh, to_wh):
-    from_wh = clean(from_wh).upper()
-    to_wh = clean(to_wh).upper()
-
-    if from_wh not in ("WH1", "WH2") or to_wh not in ("WH1", "WH2"):
-        flash("Invalid transfer.", "error")
-        return redirect(url_for("home"))
-
     if request.method == "GET":
-        return render_template(
+        return render_static(
             "transfer.html",
             from_wh=from_wh,
             to_wh=to_wh,
@@ -1968,43 +2427,23 @@ def transfer_form(from_wh, to_wh):
         flash("Invalid Roll ID: 4-digit numeric values are blocked to avoid scanning weight by mistake.", "error")
         return redirect(url_for("transfer_form", from_wh=selected_from_wh, to_wh=selected_to_wh))
 
-    if to_loc not in locations_for(selected_to_wh):
+    if not is_valid_loc(selected_to_wh, to_loc):
         flash("Invalid destination Sub-Location.", "error")
         return redirect(url_for("transfer_form", from_wh=selected_from_wh, to_wh=selected_to_wh))
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    r = safe_select_roll(cur, roll_id)
-    if not r:
-        cur.close()
-        conn.close()
-        flash("Roll ID not found.", "error")
-        return redirect(url_for("transfer_form", from_wh=selected_from_wh, to_wh=selected_to_wh))
-
-    if r["warehouse"] != selected_from_wh:
-        cur.close()
-        conn.close()
-        flash(f"Roll is not in {selected_from_wh}.", "error")
-        return redirect(url_for("transfer_form", from_wh=selected_from_wh, to_wh=selected_to_wh))
-
-    safe_update_roll_location(cur, roll_id, selected_to_wh, to_loc)
+    with get_conn() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        action_name = ACT_MOVE_WITHIN_WH if selected_from_wh == selected_to_wh else ACT_TRANSFER
 
-    action_name = "MOVE_WITHIN_WH" if selected_from_wh == selected_to_wh else "TRANSFER"
+        r = safe_move_roll(cur, roll_id, selected_to_wh, to_loc, from_wh=selected_from_wh, action=action_name)
+        if not r:
+            flash("Roll ID not found.", "error")
+            return redirect(url_for("transfer_form", from_wh=selected_from_wh, to_wh=selected_to_wh))
 
-    log_movement(
-        cur,
-        roll_id=roll_id,
-        action=action_name,
-        from_wh=selected_from_wh,
-        to_wh=selected_to_wh,
-        from_loc=r["location"],
-        to_loc=to_loc
-    )
+        if not r["moved"]:
+            flash(f"Roll is not in {selected_from_wh}.", "error")
+            return redirect(url_for("transfer_form", from_wh=selected_from_wh, to_wh=selected_to_wh))
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
 
     flash("Moved successfully.", "success")
     return redirect(url_for("inventory", warehouse=selected_to_wh))
@@ -2015,7 +2454,7 @@ def transfer_form(from_wh, to_wh):
 @require_write
 def remove_form():
     if request.method == "GET":
-        return render_template("remove.html")
+        return render_static("remove.html")
 
     roll_id = clean(request.form.get("roll_id"))
     if not roll_id:
@@ -2026,23 +2465,13 @@ def remove_form():
         flash("Invalid Roll ID: 4-digit numeric values are blocked to avoid scanning weight by mistake.", "error")
         return redirect(url_for("remove_form"))
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    r = safe_select_roll(cur, roll_id)
-    if not r:
-        cur.close()
-        conn.close()
-        flash("Roll ID not found.", "error")
-        return redirect(url_for("remove_form"))
-
-    safe_update_roll_location(cur, roll_id, "USED", "USED")
-    log_movement(cur, roll_id=roll_id, action="REMOVE_TO_USED",
-                 from_wh=r["warehouse"], to_wh="USED", from_loc=r["location"], to_loc="USED")
+    with get_conn() as conn, conn.cursor() as cur:
+        r = safe_move_roll(cur, roll_id, "USED", "USED", action=ACT_REMOVE_TO_USED)
+        if not r:
+            flash("Roll ID not found.", "error")
+            return redirect(url_for("remove_form"))
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
 
     flash("Moved to USED.", "success")
     return redirect(url_for("remove_form"))
@@ -2053,41 +2482,40 @@ def remove_form():
 @require_write
 def remove_batch_form():
     if request.method == "GET":
-        return render_template("remove_batch.html")
+        return render_static("remove_batch.html")
 
     raw = clean(request.form.get("roll_ids"))
     if not raw:
         flash("Paste/scan roll IDs first.", "error")
         return redirect(url_for("remove_batch_form"))
 
-    ids = [x for x in re.split(r"[\s,;]+", raw) if x.strip()]
-    ids = list(dict.fromkeys(ids))
-
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    ids = parse_roll_ids_multiline(raw)
 
-    moved = 0
-    missing = []
-    blocked = []
+    blocked = [rid for rid in ids if looks_like_scanned_weight(rid)]
+    candidates = [rid for rid in ids if not looks_like_scanned_weight(rid)]
 
-    for rid in ids:
-        if looks_like_scanned_weight(rid):
-            blocked.append(rid)
-            continue
+    with get_conn() as conn, conn.cursor() as cur:
+        found = safe_select_roll_places(cur, candidates, lock=True)
+        missing = [rid for rid in candidates if rid not in found]
+        to_move = [rid for rid in candidates if rid in found]
 
-        r = safe_select_roll(cur, rid)
-        if not r:
-            missing.append(rid)
-            continue
+        relax_batch_commit(cur)
+        safe_update_rolls_location(cur, to_move, "USED", "USED")
+        log_movements(cur, [
+            {
+                "roll_id": rid,
+                "action": ACT_BATCH_REMOVE_TO_USED,
+                "from_wh": found[rid][0],
+                "to_wh": "USED",
+                "from_loc": found[rid][1],
+                "to_loc": "USED",
+            }
+            for rid in to_move
+        ])
 
-        safe_update_roll_location(cur, rid, "USED", "USED")
-        log_movement(cur, roll_id=rid, action="BATCH_REMOVE_TO_USED",
-                     from_wh=r["warehouse"], to_wh="USED", from_loc=r["location"], to_loc="USED")
-        moved += 1
+        conn.commit()
 
-    conn.commit()
-    cur.close()
-    conn.close()
+    moved = len(to_move)
 
     msg = f"Moved {moved} roll(s) to USED."
     if missing:
@@ -2102,7 +2530,7 @@ def remove_batch_form():
 @require_write
 def transfer_batch_form():
     if request.method == "GET":
-        return render_template(
+        return render_static(
             "transfer_batch.html",
             warehouses=["WH1", "WH2"],
             wh1_locations=locations_for("WH1"),
@@ -2122,7 +2550,7 @@ def transfer_batch_form():
         flash("Destination Sub-Location is required.", "error")
         return redirect(url_for("transfer_batch_form"))
 
-    if to_loc not in locations_for(to_wh):
+    if not is_valid_loc(to_wh, to_loc):
         flash("Invalid destination Sub-Location.", "error")
         return redirect(url_for("transfer_batch_form"))
 
@@ -2132,47 +2560,38 @@ def transfer_batch_form():
 
     ids = parse_roll_ids_multiline(raw)
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    moved = 0
-    missing = []
-    blocked = []
-    wrong_wh = []
-
-    for rid in ids:
-        if looks_like_scanned_weight(rid):
-            blocked.append(rid)
-            continue
-
-        r = safe_select_roll(cur, rid)
-        if not r:
-            missing.append(rid)
-            continue
-
-        if r["warehouse"] != from_wh:
-            wrong_wh.append(f"{rid}({r['warehouse']})")
-            continue
+    blocked = [rid for rid in ids if looks_like_scanned_weight(rid)]
+    candidates = [rid for rid in ids if not looks_like_scanned_weight(rid)]
 
-        safe_update_roll_location(cur, rid, to_wh, to_loc)
+    with get_conn() as conn, conn.cursor() as cur:
+        found = safe_select_roll_places(cur, candidates, lock=True)
+        missing = [rid for rid in candidates if rid not in found]
+        wrong_wh = [
+            f"{rid}({found[rid][0]})"
+            for rid in candidates
+            if rid in found and found[rid][0] != from_wh
+        ]
+        to_move = [rid for rid in candidates if rid in found and found[rid][0] == from_wh]
 
-        action_name = "BATCH_MOVE_WITHIN_WH" if from_wh == to_wh else "BATCH_TRANSFER"
+        action_name = ACT_BATCH_MOVE_WITHIN_WH if from_wh == to_wh else ACT_BATCH_TRANSFER
 
-        log_movement(
-            cur,
-            roll_id=rid,
-            action=action_name,
-            from_wh=from_wh,
-            to_wh=to_wh,
-            from_loc=r["location"],
-            to_loc=to_loc,
-        )
+        relax_batch_commit(cur)
+        safe_update_rolls_location(cur, to_move, to_wh, to_loc)
+        log_movements(cur, [
+            {
+                "roll_id": rid,
+                "action": action_name,
+                "from_wh": from_wh,
+                "to_wh": to_wh,
+                "from_loc": found[rid][1],
+                "to_loc": to_loc,
+            }
+            for rid in to_move
+        ])
 
-        moved += 1
+        conn.commit()
 
-    conn.commit()
-    cur.close()
-    conn.close()
+    moved = len(to_move)
 
     msg = f"Moved {moved} roll(s)."
     if missing:
@@ -2190,7 +2609,7 @@ def transfer_batch_form():
 @require_write
 def add_batch_form():
     if request.method == "GET":
-        return render_template(
+        return render_static(
             "add_batch.html",
             warehouses=["WH1", "WH2"],
             wh1_locations=locations_for("WH1"),
@@ -2214,7 +2633,7 @@ def add_batch_form():
         flash("Sub-Location is required.", "error")
         return redirect(url_for("add_batch_form"))
 
-    if location not in locations_for(warehouse):
+    if not is_valid_loc(warehouse, location):
         flash("Invalid Sub-Location for selected warehouse.", "error")
         return redirect(url_for("add_batch_form"))
 
@@ -2224,54 +2643,27 @@ def add_batch_form():
         flash("No valid roll rows found.", "error")
         return redirect(url_for("add_batch_form"))
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    added = 0
-    duplicates = []
-    failed = list(parse_errors)
-
-    try:
-        for row in parsed_rows:
-            roll_id = row["roll_id"]
-            weight_lbs = row["weight_lbs"]
-
-            existing = safe_select_roll(cur, roll_id)
-            if existing:
-                duplicates.append(roll_id)
-                continue
-
-            try:
-                safe_insert_roll(cur, roll_id, paper_type, weight_lbs, warehouse, location)
-
-                log_movement(
-                    cur,
-                    roll_id=roll_id,
-                    action="BATCH_ADD",
-                    from_wh=warehouse,
-                    to_wh=warehouse,
-                    from_loc=location,
-                    to_loc=location,
-                )
-
-                added += 1
-
-            except Exception as row_error:
-                conn.rollback()
-                cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-                failed.append(f"{roll_id}: {str(row_error)}")
-
-        conn.commit()
-
-    except Exception as e:
-        conn.rollback()
-        cur.close()
-        conn.close()
-        flash(f"Batch add failed: {str(e)}", "error")
-        return redirect(url_for("add_batch_form"))
-
-    cur.close()
-    conn.close()
+    with get_conn() as conn, conn.cursor() as cur:
+        try:
+            relax_batch_commit(cur)
+            inserted = safe_insert_rolls(
+                cur,
+                ((row["roll_id"], row["weight_lbs"]) for row in parsed_rows),
+                paper_type,
+                warehouse,
+                location,
+                action=ACT_BATCH_ADD,
+            )
+            conn.commit()
+
+        except Exception as e:
+            conn.rollback()
+            flash(f"Batch add failed: {str(e)}", "error")
+            return redirect(url_for("add_batch_form"))
+
+    added = len(inserted)
+    duplicates = [row["roll_id"] for row in parsed_rows if row["roll_id"] not in inserted]
+    failed = parse_errors
 
     msg = f"Added {added} roll(s) for Paper Type {paper_type}."
     if duplicates:
@@ -2288,112 +2680,129 @@ def search():
     q = clean(request.args.get("q"))
     selected = clean(request.args.get("paper"))
 
+    # Busqueda vacia: el formulario solo, memoizado y sin pedir conexion al pool
+    if not q and not selected:
+        return render_static(
+            "search.html",
+            q="",
+            matches=[],
+            selected="",
+            rolls=[],
+            totals=None,
+            sublocation_summary=[],
+            warehouse_weight_summary=[],
+        )
+
     matches = []
     rolls = []
     totals = None
     sublocation_summary = []
     warehouse_weight_summary = []
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    paper_col = "paper_type"
-    wh_col = "warehouse"
-    loc_col = "location"
-    weight_col = "weight_lbs"
-
-    loc_expr = f"COALESCE({loc_col}::text, '')"
-    weight_expr = f"COALESCE({weight_col}, 0)"
-
-    if q:
-        cur.execute(
-            f"""
-            SELECT DISTINCT {paper_col} AS paper_type
-            FROM rolls
-            WHERE {paper_col} ILIKE %s
-            ORDER BY {paper_col}
-            LIMIT 100
-            """,
-            (f"%{q}%",),
-        )
-        matches = cur.fetchall() or []
-
-    if selected:
-        cur.execute(
-            f"""
-            SELECT
-                roll_id,
-                {wh_col} AS warehouse,
-                {loc_expr} AS sublocation,
-                {weight_expr} AS weight_lbs
-            FROM rolls
-            WHERE {paper_col} = %s
-            ORDER BY
-                {wh_col},
-                CASE
-                    WHEN {loc_expr} ~ '^[0-9]+$' THEN CAST({loc_expr} AS INTEGER)
-                    ELSE 999
-                END,
-                roll_id
-            """,
-            (selected,),
-        )
-        rolls = cur.fetchall() or []
-
-        cur.execute(
-            f"""
-            SELECT
-                COUNT(*) AS cnt,
-                COUNT(*) FILTER (WHERE {wh_col} = 'WH1') AS wh1_cnt,
-                COUNT(*) FILTER (WHERE {wh_col} = 'WH2') AS wh2_cnt,
-                COUNT(*) FILTER (WHERE {wh_col} = 'CONSUMED') AS consumed_cnt,
-                COUNT(*) FILTER (WHERE {wh_col} = 'USED') AS used_cnt,
-                COALESCE(SUM({weight_expr}), 0) AS total_weight
-            FROM rolls
-            WHERE {paper_col} = %s
-            """,
-            (selected,),
-        )
-        totals = cur.fetchone()
-
-        cur.execute(
-            f"""
-            SELECT
-                {wh_col} AS warehouse,
-                {loc_expr} AS sublocation,
-                COUNT(*) AS cnt
-            FROM rolls
-            WHERE {paper_col} = %s
-            GROUP BY {wh_col}, {loc_expr}
-            ORDER BY
-                {wh_col},
-                CASE
-                    WHEN {loc_expr} ~ '^[0-9]+$' THEN CAST({loc_expr} AS INTEGER)
-                    ELSE 999
-                END,
-                {loc_expr}
-            """,
-            (selected,),
-        )
-        sublocation_summary = cur.fetchall() or []
-
-        cur.execute(
-            f"""
-            SELECT
-                {wh_col} AS warehouse,
-                COUNT(*) AS cnt,
-                COALESCE(SUM({weight_expr}), 0) AS total_weight
-            FROM rolls
-            WHERE {paper_col} = %s
-            GROUP BY {wh_col}
-            ORDER BY {wh_col}
-            """,
-            (selected,),
-        )
-        warehouse_weight_summary = cur.fetchall() or []
-
-    cur.close()
-    conn.close()
+    with get_conn(readonly=True) as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        paper_col = "paper_type"
+        wh_col = "warehouse"
+        loc_col = "location"
+        weight_col = "weight_lbs"
+
+        loc_expr = f"COALESCE({loc_col}::text, '')"
+        weight_expr = f"COALESCE({weight_col}, 0)"
+
+        if q:
+            # Una palabra: substring con ILIKE (indice trigram). Varias: ademas se busca cada
+            # palabra como prefijo en el indice full text, en cualquier orden.
+            terms = _SEARCH_TERMS.findall(q.lower())
+            match_sql = f"{paper_col} ILIKE %s"
+            params = (f"%{q}%",)
+            if len(terms) > 1:
+                match_sql = f"{paper_tsvector_sql(paper_col)} @@ to_tsquery('simple', %s) OR " + match_sql
+                params = (" & ".join(f"{t}:*" for t in terms),) + params
+
+            cur.execute(
+                f"""
+                SELECT DISTINCT {paper_col} AS paper_type
+                FROM rolls
+                WHERE {match_sql}
+                ORDER BY {paper_col}
+                LIMIT 100
+                """,
+                params,
+            )
+            matches = cur.fetchall() or []
+
+        if selected:
+            cur.execute(
+                f"""
+                SELECT
+                    roll_id,
+                    {wh_col} AS warehouse,
+                    {loc_expr} AS sublocation,
+                    {weight_expr} AS weight_lbs
+                FROM rolls
+                WHERE {paper_col} = %s
+                ORDER BY
+                    {wh_col},
+                    CASE
+                        WHEN {loc_expr} ~ '^[0-9]+$' THEN CAST({loc_expr} AS INTEGER)
+                        ELSE 999
+                    END,
+                    roll_id
+                """,
+                (selected,),
+            )
+            rolls = cur.fetchall() or []
+
+            cur.execute(
+                f"""
+                SELECT
+                    COUNT(*) AS cnt,
+                    COUNT(*) FILTER (WHERE {wh_col} = 'WH1') AS wh1_cnt,
+                    COUNT(*) FILTER (WHERE {wh_col} = 'WH2') AS wh2_cnt,
+                    COUNT(*) FILTER (WHERE {wh_col} = 'CONSUMED') AS consumed_cnt,
+                    COUNT(*) FILTER (WHERE {wh_col} = 'USED') AS used_cnt,
+                    COALESCE(SUM({weight_expr}), 0) AS total_weight
+                FROM rolls
+                WHERE {paper_col} = %s
+                """,
+                (selected,),
+            )
+            totals = cur.fetchone()
+
+            cur.execute(
+                f"""
+                SELECT
+                    {wh_col} AS warehouse,
+                    {loc_expr} AS sublocation,
+                    COUNT(*) AS cnt
+                FROM rolls
+                WHERE {paper_col} = %s
+                GROUP BY {wh_col}, {loc_expr}
+                ORDER BY
+                    {wh_col},
+                    CASE
+                        WHEN {loc_expr} ~ '^[0-9]+$' THEN CAST({loc_expr} AS INTEGER)
+                        ELSE 999
+                    END,
+                    {loc_expr}
+                """,
+                (selected,),
+            )
+            sublocation_summary = cur.fetchall() or []
+
+            cur.execute(
+                f"""
+                SELECT
+                    {wh_col} AS warehouse,
+                    COUNT(*) AS cnt,
+                    COALESCE(SUM({weight_expr}), 0) AS total_weight
+                FROM rolls
+                WHERE {paper_col} = %s
+                GROUP BY {wh_col}
+                ORDER BY {wh_col}
+                """,
+                (selected,),
+            )
+            warehouse_weight_summary = cur.fetchall() or []
 
     return render_template(
         "search.html",
@@ -2406,5 +2815,42 @@ def search():
         warehouse_weight_summary=warehouse_weight_summary,
     )
 
+def warm_templates():
+    """Compila todos los templates al importar, para que el primer request no pague el parse."""
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+
+
+warm_templates()
+
+_db_init_lock = threading.Lock()
+_db_init_pending = False
+
+
+def _retry_init_db():
+    """Reintenta init_db en el primer request si Postgres no respondia al importar."""
+    global _db_init_pending
+    if not _db_init_pending:
+        return
+    with _db_init_lock:
+        if _db_init_pending:
+            init_db()
+            _db_init_pending = False
+
+
+# El esquema se prepara una vez al importar (cada worker de gunicorn lo hace una vez, y el
+# advisory lock de init_db serializa la migracion). Con RUN_DB_INIT=0 se omite y el esquema
+# se crea aparte con `flask --app app init-db`. Sin DATABASE_URL no se intenta: la app igual
+# importa y cada request falla con el error de get_pool, como antes.
+if DATABASE_URL and os.environ.get("RUN_DB_INIT", "1") == "1":
+    try:
+        init_db()
+    except psycopg2.OperationalError as e:
+        # Postgres caido un momento no deberia tumbar el worker; el hook solo se registra aqui
+        app.logger.warning("init_db failed at import, retrying on first request: %s", e)
+        _db_init_pending = True
+        app.before_request(_retry_init_db)
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", "5000")))
@@ -0,0 +1,17 @@
+# gunicorn lee este archivo solo (desde el directorio de trabajo): `gunicorn app:app`
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Threads en vez de procesos: cada request espera casi todo el tiempo a Postgres, y los
+# threads de un worker comparten su ThreadedConnectionPool. Mantener threads <= PG_POOL_MAX.
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = int(os.environ.get("WEB_THREADS", "8"))
+
+# Sin preload: cada worker importa la app y crea su propio pool despues del fork
+# (conexiones de psycopg2 no se pueden compartir entre procesos).
+preload_app = False
+
+timeout = int(os.environ.get("WEB_TIMEOUT", "60"))
+keepalive = 5
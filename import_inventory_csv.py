@@ -1,8 +1,11 @@
 import os
+import io
 import csv
 import psycopg2
 import psycopg2.extras
 
+from app import copy_value
+
 DATABASE_URL = os.environ.get("DATABASE_URL", "")
 CSV_FILE = "combined_inventory_import.csv"
 
@@ -36,6 +39,9 @@ def main():
     skipped = 0
     errors = []
 
+    # roll_id -> fila valida; si el CSV repite un roll_id gana la ultima, igual que antes
+    valid = {}
+
     with open(CSV_FILE, newline="", encoding="utf-8-sig") as f:
         reader = csv.DictReader(f)
 
@@ -61,42 +67,62 @@ def main():
                 errors.append(f"Row {row_num}: invalid warehouse '{warehouse}'")
                 continue
 
-            try:
-                cur.execute("SELECT 1 FROM rolls WHERE roll_id=%s", (roll_id,))
-                exists = cur.fetchone() is not None
-
-                if exists:
-                    cur.execute(
-                        """
-                        UPDATE rolls
-                        SET paper_type=%s,
-                            warehouse=%s,
-                            weight=%s,
-                            weight_lbs=%s,
-                            location=%s
-                        WHERE roll_id=%s
-                        """,
-                        (paper_type, warehouse, weight, weight, location, roll_id),
-                    )
-                    updated += 1
-                else:
-                    cur.execute(
-                        """
-                        INSERT INTO rolls (roll_id, paper_type, warehouse, weight, weight_lbs, location)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                        """,
-                        (roll_id, paper_type, warehouse, weight, weight, location),
-                    )
-                    inserted += 1
-
-            except Exception as e:
-                skipped += 1
-                errors.append(f"Row {row_num}: {str(e)}")
-                conn.rollback()
-                cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            valid.pop(roll_id, None)
+            valid[roll_id] = (roll_id, paper_type, warehouse, weight, location)
+
+    # Todo el CSV entra con un solo COPY a una tabla temporal y se aplica con dos statements
+    buf = io.StringIO()
+    for values in valid.values():
+        buf.write("\t".join(copy_value(v) for v in values))
+        buf.write("\n")
+    buf.seek(0)
+
+    try:
+        cur.execute(
+            """
+            CREATE TEMP TABLE rolls_import (
+                roll_id TEXT PRIMARY KEY,
+                paper_type TEXT,
+                warehouse TEXT,
+                weight INTEGER,
+                location TEXT
+            ) ON COMMIT DROP
+            """
+        )
+        cur.copy_expert("COPY rolls_import (roll_id, paper_type, warehouse, weight, location) FROM STDIN", buf)
+
+        cur.execute(
+            """
+            UPDATE rolls
+            SET paper_type=i.paper_type,
+                warehouse=i.warehouse,
+                weight=i.weight,
+                weight_lbs=i.weight,
+                location=i.location
+            FROM rolls_import i
+            WHERE rolls.roll_id=i.roll_id
+            """
+        )
+        updated = cur.rowcount
+
+        cur.execute(
+            """
+            INSERT INTO rolls (roll_id, paper_type, warehouse, weight, weight_lbs, location)
+            SELECT i.roll_id, i.paper_type, i.warehouse, i.weight, i.weight, i.location
+            FROM rolls_import i
+            WHERE NOT EXISTS (SELECT 1 FROM rolls r WHERE r.roll_id=i.roll_id)
+            """
+        )
+        inserted = cur.rowcount
 
         conn.commit()
 
+    except Exception as e:
+        conn.rollback()
+        skipped += len(valid)
+        inserted = updated = 0
+        errors.append(f"Import rolled back: {str(e)}")
+
     cur.close()
     conn.close()
 
@@ -0,0 +1,41 @@
+import os
+import sys
+import unittest
+
+# Sin init_db al importar: estas pruebas no necesitan Postgres
+os.environ["RUN_DB_INIT"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as appmod  # noqa: E402
+
+
+class AuthCookieTest(unittest.TestCase):
+    def setUp(self):
+        self.client = appmod.app.test_client()
+
+    def get_with_cookie(self, path, value):
+        self.client.set_cookie(appmod.AUTH_COOKIE, value)
+        return self.client.get(path)
+
+    def test_malformed_cookies_redirect_to_login(self):
+        for value in ("admin.²².x", "admin.123.éé", "admin..", "garbage", "a.b.c.d"):
+            with self.subTest(value=value):
+                resp = self.get_with_cookie("/", value)
+                self.assertEqual(resp.status_code, 302)
+                self.assertTrue(resp.headers["Location"].endswith("/login"))
+
+    def test_malformed_cookie_still_serves_login_page(self):
+        resp = self.get_with_cookie("/login", "admin.²².x")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_valid_token_is_accepted(self):
+        self.assertEqual(appmod._role_from_token(appmod._auth_token("admin")), "admin")
+
+    def test_expired_token_is_rejected(self):
+        issued = "1"
+        token = f"admin.{issued}.{appmod._auth_sig('admin', issued)}"
+        self.assertEqual(appmod._role_from_token(token), "")
+
+
+if __name__ == "__main__":
+    unittest.main()